@@ -85,13 +85,14 @@ def convert_csv_to_json(input_path,output_path=None):
 
     images = []
     
-    # iFile = 0; row = df.iloc[iFile]
-    for iFile,row in df.iterrows():
+    # Pull out the columns we need, rather than constructing a Series for every row
+    for image_path, max_confidence, src_detections in zip(df['image_path'].to_numpy(),
+                                                          df['max_confidence'].to_numpy(),
+                                                          df['detections'].to_numpy()):
         
         image = {}
-        image['file'] = row['image_path']
-        image['max_detection_conf'] = row['max_confidence']
-        src_detections = row['detections']        
+        image['file'] = image_path
+        image['max_detection_conf'] = max_confidence
         out_detections = []
         
         for iDetection,detection in enumerate(src_detections):
@@ -17,25 +17,52 @@
 # %% Imports and environment
 
 import argparse
+import math
 import os
+import re
 import sys
 import warnings
 import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import lru_cache, partial
 from itertools import compress
 
 import jsonpickle
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+# orjson is optional; without it, we read and write detection index files with the json module
+try:
+    import orjson
+    bOrjsonAvailable = True
+except ImportError:
+    bOrjsonAvailable = False
+
+# numba is optional; without it, we always use the NumPy IoU path
+try:
+    from numba import njit
+    bNumbaAvailable = True
+except ImportError:
+    bNumbaAvailable = False
+
+# OpenCV is optional; without it, we always render with PIL
+try:
+    import cv2
+    bOpenCVAvailable = True
+except ImportError:
+    bOpenCVAvailable = False
+
 # from ai4eutils; this is assumed to be on the path, as per repo convention
 import write_html_image_list
 import path_utils
 
 from api.batch_processing.postprocessing.load_api_results import load_api_results, write_api_results
 import ct_utils
-from visualization.visualization_utils import open_image, render_detection_bounding_boxes
+from PIL import Image, ImageColor
+from visualization.visualization_utils import open_image, render_detection_bounding_boxes, COLORS
 
 # Imports I'm not using but use when I tinker with parallelization
 #
@@ -44,6 +71,28 @@ from visualization.visualization_utils import open_image, render_detection_bound
 # import multiprocessing
 # import joblib
 
+# When a directory has more candidate locations than this, use the fused numba IoU
+# kernel (if numba is available) rather than the NumPy version
+NUMBA_MIN_CANDIDATES = 64
+
+# Upper bound on the number of cells per dimension in the grid we use to find
+# nearby candidate locations; see get_grid_size()
+MAX_GRID_SIZE = 100
+
+# Written to detectionIndex.json files that store plain dicts (see write_detection_index());
+# older files are jsonpickle-encoded object graphs with no version field
+DETECTION_INDEX_VERSION = 2
+
+# When rendering in parallel, how many source images should we hand to a worker at once?
+RENDER_CHUNK_SIZE = 16
+
+# When rendering serially, how many threads should encode and write images while the 
+# main thread decodes and draws?
+N_ENCODE_THREADS = 4
+
+# The colors draw_bounding_box_on_image() uses for each class, as BGR tuples for OpenCV
+COLORS_BGR = [ImageColor.getrgb(color)[::-1] for color in COLORS]
+
 # ignoring all "PIL cannot read EXIF metainfo for the images" warnings
 warnings.filterwarnings('ignore', '(Possibly )?corrupt EXIF data', UserWarning)
 # Metadata Warning, tag 256 had too many entries: 42, expected 1
@@ -72,6 +121,10 @@ class RepeatDetectionOptions:
     # are required before we declare it suspicious?
     occurrenceThreshold = 15
 
+    # Can a single detection count as an occurrence of more than one location?  If not,
+    # each detection is assigned only to the location it most recently matched.
+    bAllowMultiMatch = False
+
     # Ignore "suspicious" detections larger than some size; these are often animals
     # taking up the whole image.  This is expressed as a fraction of the image size.
     maxSuspiciousDetectionSize = 0.2
@@ -106,6 +159,30 @@ class RepeatDetectionOptions:
     bParallelizeComparisons = True
     bParallelizeRendering = True
 
+    # Render with OpenCV (if it's available), which is much faster than PIL at decoding and
+    # encoding JPEGs.  The OpenCV path draws boxes in the same colors as the PIL path, but
+    # doesn't draw labels, and writes JPEGs at a different quality, so it's off by default.
+    bRenderWithOpenCV = False
+
+    # If this is >= 0, sample images in the filtering folder are cropped to the suspicious
+    # box, expanded by this fraction of the box size on each side, which makes them much
+    # cheaper to draw and encode.  Set to -1 to write full frames.
+    sampleImageCropMargin = -1
+
+    # Image format for sample images in the filtering folder, 'jpg' or 'webp'.  WebP files
+    # are substantially smaller at similar quality.
+    sampleImageFormat = 'jpg'
+
+    # If this is > 0, JPEG sample images in the filtering folder are decoded at reduced 
+    # resolution (by a power of two), to the smallest size whose shorter side is at least 
+    # this many pixels.  This makes decoding much cheaper for large images.  Does not 
+    # affect html output.  Set to -1 to decode at full resolution.
+    sampleImageMaxSize = -1
+
+    # Re-compute the IoU between every suspicious instance and its detection location
+    # when updating the detection table (slow, for debugging only)
+    bVerifyIou = False
+
     bPrintMissingImageWarnings = True
     missingImageWarningType = 'once'  # 'all'
 
@@ -138,7 +215,8 @@ class RepeatDetectionResults:
     # dict mapping folder names to whole rows from the data table
     rowsByDirectory = None
 
-    # dict mapping filenames to rows in the master table
+    # pandas Index over the 'file' column of the master table, i.e. mapping filenames 
+    # to row positions (via get_loc() / get_indexer())
     filenameToRow = None
 
     # An array of length nDirs, where each element is a list of DetectionLocation 
@@ -152,6 +230,9 @@ class RepeatDetectionResults:
 
 class IndexedDetection:
 
+    # There can be millions of these, so we don't give each one a __dict__
+    __slots__ = ('iDetection', 'filename', 'bbox', 'confidence', 'category')
+
     def __init__(self, iDetection=-1, filename='', bbox=[], confidence=-1, category='unknown'):
         """
         A single detection event on a single image
@@ -171,6 +252,15 @@ class IndexedDetection:
         s = ct_utils.pretty_print_object(self, False)
         return s
 
+    def to_dict(self):
+        return {'iDetection':self.iDetection,'filename':self.filename,'bbox':self.bbox,
+                'confidence':self.confidence,'category':self.category}
+
+    @staticmethod
+    def from_dict(d):
+        return IndexedDetection(iDetection=d['iDetection'], filename=d['filename'], bbox=d['bbox'],
+                                confidence=d['confidence'], category=d['category'])
+
 
 class DetectionLocation:
     """
@@ -178,12 +268,17 @@ class DetectionLocation:
     directory
     """
 
+    __slots__ = ('instances', 'bbox', 'relativeDir', 'sampleImageRelativeFileName', 'xyxy', 'area')
+
     def __init__(self, instance, detection, relativeDir):
         self.instances = [instance]  # list of IndexedDetections
         self.bbox = detection['bbox']
         self.relativeDir = relativeDir
         self.sampleImageRelativeFileName = ''
 
+        # Cached [x_min, y_min, x_max, y_max] corners and area, for IoU comparisons
+        self.xyxy, self.area = get_xyxy_and_area(self.bbox)
+
     def __repr__(self):
         s = ct_utils.pretty_print_object(self, False)
         return s
@@ -196,6 +291,129 @@ class DetectionLocation:
         detection = {'conf':self.instances[0].confidence,'bbox':self.bbox,'category':self.instances[0].category}
         return detection
 
+    def to_dict(self):
+        """
+        Converts to a plain dict, for writing to a detection index file.  Cached fields 
+        that can be derived from the bbox are not included.
+        """
+        return {'instances':[instance.to_dict() for instance in self.instances],'bbox':self.bbox,
+                'relativeDir':self.relativeDir,'sampleImageRelativeFileName':self.sampleImageRelativeFileName}
+
+    @staticmethod
+    def from_dict(d):
+        instances = [IndexedDetection.from_dict(instance) for instance in d['instances']]
+        location = DetectionLocation(instances[0], {'bbox':d['bbox']}, d['relativeDir'])
+        location.instances = instances
+        location.sampleImageRelativeFileName = d['sampleImageRelativeFileName']
+        return location
+
+
+class CandidateSet:
+    """
+    The candidate locations found so far in one directory, stored as parallel arrays
+    (rather than a list of DetectionLocations) so a new box can be compared to all of
+    them in one pass.
+    """
+
+    def __init__(self, iouThreshold, capacity=16):
+        
+        self.iouThreshold = iouThreshold
+
+        # (capacity,4) array of [x_min, y_min, x_max, y_max] boxes and length-capacity
+        # array of their areas.  Only the first n rows are valid.
+        self.xyxy = np.empty((capacity, 4), dtype=np.float64)
+        self.area = np.empty(capacity, dtype=np.float64)
+        self.n = 0
+
+        # For each candidate, when it was last added to or matched, as a count of 
+        # updates to this set, so we can find the most recently matched candidate
+        self.lastHit = np.empty(capacity, dtype=np.int64)
+        self.nHits = 0
+
+        # For each candidate, the API detection that created it, and the list of
+        # IndexedDetections that match it
+        self.detections = []
+        self.instances = []
+
+        # dict mapping (column, row) grid cells to lists of candidate indices, bucketed
+        # by box center, so we only compare each new box to nearby candidates
+        self.gridSize = get_grid_size(iouThreshold)
+        self.grid = {}
+
+    def _grow(self):
+        """
+        Doubles the capacity of the bbox arrays
+        """
+        
+        self.xyxy = np.concatenate((self.xyxy, np.empty_like(self.xyxy)))
+        self.area = np.concatenate((self.area, np.empty_like(self.area)))
+        self.lastHit = np.concatenate((self.lastHit, np.empty_like(self.lastHit)))
+
+    def find_matches(self, xyxy, area, cell):
+        """
+        Returns the indices of all candidates whose IoU with a box is at least iouThreshold,
+        given that box's [x_min, y_min, x_max, y_max] corners, area, and grid cell (see
+        get_xyxy_and_area_many() and get_grid_cells()).
+        """
+        
+        iNearbyCandidates = get_nearby_candidates(self.grid, cell)
+        if len(iNearbyCandidates) == 0:
+            return iNearbyCandidates
+
+        return iNearbyCandidates[find_matching_candidates(
+            xyxy, area, self.xyxy[iNearbyCandidates], self.area[iNearbyCandidates], self.iouThreshold)]
+
+    def most_recent(self, iCandidates):
+        """
+        Returns the index in *iCandidates* that was most recently added to or matched
+        """
+        
+        return iCandidates[np.argmax(self.lastHit[iCandidates])]
+
+    def add_instance(self, iCandidate, instance):
+        """
+        Records *instance* as an occurrence of candidate *iCandidate*
+        """
+        
+        self.instances[iCandidate].append(instance)
+        self.lastHit[iCandidate] = self.nHits
+        self.nHits += 1
+
+    def add(self, instance, detection, xyxy, area, cell):
+        """
+        Adds a new candidate location, initially matched only by *instance*; *xyxy*, *area*,
+        and *cell* are as for find_matches().
+        """
+        
+        if self.n == self.xyxy.shape[0]:
+            self._grow()
+
+        self.xyxy[self.n] = xyxy
+        self.area[self.n] = area
+        self.detections.append(detection)
+        self.instances.append([instance])
+        self.lastHit[self.n] = self.nHits
+        self.nHits += 1
+
+        if cell not in self.grid:
+            self.grid[cell] = []
+        self.grid[cell].append(self.n)
+
+        self.n += 1
+
+    def to_detection_locations(self, relativeDir):
+        """
+        Converts to a list of DetectionLocation objects, in the order in which candidates
+        were added
+        """
+        
+        locations = []
+        for detection, instances in zip(self.detections, self.instances):
+            location = DetectionLocation(instances[0], detection, relativeDir)
+            location.instances = instances
+            locations.append(location)
+        return locations
+
 
 ##%% Helper functions
 
@@ -219,12 +437,473 @@ def enumerate_images(dirName,outputFileName=None):
     return imageList
     
 
+def find_existing_files(baseDir, relativeFileNames):
+    """
+    Returns the set of filenames in *relativeFileNames* (relative to *baseDir*) that exist,
+    by listing each of their directories once, rather than stat'ing every file.  Filenames
+    are returned exactly as they appear in *relativeFileNames*.
+    
+    Filenames that aren't in the listing are checked with os.path.isfile(), so that names
+    that only differ from the file on disk in case still count as existing on 
+    case-insensitive file systems (e.g. Windows and macOS).
+    """
+    
+    filesByDir = {}
+    for relativeDir in set([os.path.dirname(fn) for fn in relativeFileNames]):
+        fullDir = os.path.join(baseDir, relativeDir)
+        if not os.path.isdir(fullDir):
+            filesByDir[relativeDir] = set()
+            continue
+        with os.scandir(fullDir) as it:
+            filesByDir[relativeDir] = set([entry.name for entry in it if entry.is_file()])
+
+    return set([fn for fn in relativeFileNames 
+                if os.path.basename(fn) in filesByDir[os.path.dirname(fn)]
+                or os.path.isfile(os.path.join(baseDir, fn))])
+
+
+@lru_cache(maxsize=None)
+def list_files_in_dir(dirName):
+    """
+    Returns the names of the files in *dirName* (or an empty set if it doesn't exist), 
+    cached so that repeated existence checks against the same directory only list it 
+    once.  Call list_files_in_dir.cache_clear() when done, so the cache doesn't outlive
+    the files it describes.
+    """
+    
+    if not os.path.isdir(dirName):
+        return frozenset()
+    with os.scandir(dirName) as it:
+        return frozenset([entry.name for entry in it if entry.is_file()])
+
+
+def write_detection_index(suspiciousDetections, detectionIndexFileName):
+    """
+    Writes a length-nDirs list of lists of DetectionLocation objects to a detection
+    index file (typically detectionIndex.json), as plain dicts.
+    """
+    
+    detectionIndex = {'version':DETECTION_INDEX_VERSION,
+                      'suspiciousDetections':[[location.to_dict() for location in locations]
+                                              for locations in suspiciousDetections]}
+    # This file is meant to be human-readable, but indent=4 roughly doubles its size 
+    # relative to indent=2.  We don't sort keys; to_dict() already emits them in a fixed
+    # order, so output is stable without a sort pass over every dict.
+    if bOrjsonAvailable:
+        with open(detectionIndexFileName, 'wb') as f:
+            f.write(orjson.dumps(detectionIndex, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+                                 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        # json.dump() writes incrementally, rather than building the whole string first
+        with open(detectionIndexFileName, 'w') as f:
+            json.dump(detectionIndex, f, indent=2)
+
+
+def load_detection_index(detectionIndexFileName):
+    """
+    Loads a detection index file written by write_detection_index(), or by older versions
+    of this module via jsonpickle, returning a length-nDirs list of lists of 
+    DetectionLocation objects.
+    """
+    
+    with open(detectionIndexFileName, 'rb') as f:
+        s = f.read()
+
+    detectionIndex = None
+    if bOrjsonAvailable:
+        try:
+            detectionIndex = orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than json, e.g. it doesn't accept the NaN values 
+            # json.dump writes by default
+            pass
+    if detectionIndex is None:
+        detectionIndex = json.loads(s)
+
+    # Older index files are a bare jsonpickle'd list, which may contain references
+    # between objects, so we need jsonpickle to rebuild them
+    if not isinstance(detectionIndex, dict):
+        return jsonpickle.decode(s.decode('utf-8'))
+
+    assert detectionIndex['version'] == DETECTION_INDEX_VERSION
+    return [[DetectionLocation.from_dict(location) for location in locations]
+            for locations in detectionIndex['suspiciousDetections']]
+
+
+def get_xyxy_and_area(bbox):
+    """
+    Converts an [x_min, y_min, width_of_box, height_of_box] box to its [x_min, y_min, x_max, y_max]
+    corners and its area.  The area is computed from the corners, as in ct_utils.get_iou(),
+    so IoU values computed from these are identical to get_iou().
+    """
+    
+    xyxy = ct_utils.convert_xwyh_to_xyxy(bbox)
+    area = (xyxy[2] - xyxy[0]) * (xyxy[3] - xyxy[1])
+    return xyxy, area
+
+
+def get_xyxy_and_area_many(bboxes):
+    """
+    Vectorized version of get_xyxy_and_area(...): converts an (N,4) array of [x_min, y_min,
+    width_of_box, height_of_box] rows to an (N,4) array of [x_min, y_min, x_max, y_max] rows
+    and a length-N array of areas.  This is the same float64 arithmetic, so the results are 
+    identical to the scalar version.
+    """
+    
+    xyxy = np.empty_like(bboxes)
+    xyxy[:, 0:2] = bboxes[:, 0:2]
+    xyxy[:, 2:4] = bboxes[:, 0:2] + bboxes[:, 2:4]
+    area = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    return xyxy, area
+
+
+def get_iou_many(xyxy, area, candidateBboxes, candidateAreas):
+    """
+    Vectorized version of ct_utils.get_iou(...): computes the IoU between a single box
+    and every row of an array of boxes at once.
+
+    Args:
+        xyxy: [x_min, y_min, x_max, y_max]
+        area: area of *xyxy*, as returned by get_xyxy_and_area()
+        candidateBboxes: (M,4) float array of [x_min, y_min, x_max, y_max] rows
+        candidateAreas: length-M float array of the areas of *candidateBboxes*
+
+    Returns:
+        length-M float array of IoU values, in the same order as *candidateBboxes*
+    """
+    
+    x_min, y_min, x_max, y_max = xyxy
+
+    # Determine the coordinates of the intersection rectangles; the arithmetic below
+    # mirrors get_iou(), so matches are identical to the scalar version.
+    x_left = np.maximum(x_min, candidateBboxes[:, 0])
+    y_top = np.maximum(y_min, candidateBboxes[:, 1])
+    x_right = np.minimum(x_max, candidateBboxes[:, 2])
+    y_bottom = np.minimum(y_max, candidateBboxes[:, 3])
+
+    intersection_area = np.clip(x_right - x_left, 0, None) * np.clip(y_bottom - y_top, 0, None)
+
+    return intersection_area / (area + candidateAreas - intersection_area)
+
+
+if bNumbaAvailable:
+
+    @njit(cache=True, boundscheck=False)
+    def get_iou_mask_numba(x_min, y_min, x_max, y_max, area, candidateBboxes, candidateAreas,
+                           iouThreshold, bMatches):
+        """
+        Single-pass equivalent of get_iou_many(...) >= iouThreshold, writing the result into
+        *bMatches* without allocating any temporary arrays.  We don't use fastmath, so results
+        are identical to the NumPy version.
+        """
+        
+        for i in range(candidateBboxes.shape[0]):
+
+            x_left = max(x_min, candidateBboxes[i, 0])
+            y_top = max(y_min, candidateBboxes[i, 1])
+            x_right = min(x_max, candidateBboxes[i, 2])
+            y_bottom = min(y_max, candidateBboxes[i, 3])
+
+            if x_right < x_left or y_bottom < y_top:
+                bMatches[i] = False
+                continue
+
+            intersection_area = (x_right - x_left) * (y_bottom - y_top)
+
+            bMatches[i] = intersection_area / (area + candidateAreas[i] - intersection_area) >= iouThreshold
+
+
+def find_matching_candidates(xyxy, area, candidateBboxes, candidateAreas, iouThreshold):
+    """
+    Returns the indices of the rows in *candidateBboxes* ([x_min, y_min, x_max, y_max])
+    whose IoU with *xyxy* is at least *iouThreshold*.  See get_iou_many() for arguments.
+    """
+    
+    if bNumbaAvailable and len(candidateBboxes) > NUMBA_MIN_CANDIDATES:
+        x_min, y_min, x_max, y_max = xyxy
+        bMatches = np.empty(len(candidateBboxes), dtype=np.bool_)
+        get_iou_mask_numba(x_min, y_min, x_max, y_max, area, candidateBboxes, candidateAreas,
+                           iouThreshold, bMatches)
+    else:
+        bMatches = get_iou_many(xyxy, area, candidateBboxes, candidateAreas) >= iouThreshold
+
+    return np.where(bMatches)[0]
+
+
+def get_grid_size(iouThreshold):
+    """
+    Returns the number of cells per dimension for the grid we use to bucket candidate
+    locations by their centers.
+    
+    If two boxes with widths and heights <= 1 have an IoU of at least t, their centers
+    are no more than (1-t) apart in each dimension.  So as long as the cells are at least
+    that big, any match for a box is in the same cell as the box or in one of the 8
+    neighboring cells.  We drop one cell to leave some slack for floating-point error.
+    """
+    
+    if iouThreshold >= 1.0:
+        return MAX_GRID_SIZE
+    gridSize = int(1.0 / (1.0 - iouThreshold)) - 1
+    return max(1, min(MAX_GRID_SIZE, gridSize))
+
+
+def get_grid_cell(bbox, gridSize):
+    """
+    Returns the (column, row) grid cell containing the center of *bbox* 
+    ([x_min, y_min, width_of_box, height_of_box]).
+    """
+    
+    x_min, y_min, width_of_box, height_of_box = bbox
+    return (math.floor((x_min + width_of_box / 2.0) * gridSize),
+            math.floor((y_min + height_of_box / 2.0) * gridSize))
+
+
+def get_grid_cells(bboxes, gridSize):
+    """
+    Vectorized version of get_grid_cell(...): returns an (N,2) int array of the (column, row)
+    grid cells containing the centers of an (N,4) array of [x_min, y_min, width_of_box, 
+    height_of_box] rows.
+    """
+    
+    return np.floor((bboxes[:, 0:2] + bboxes[:, 2:4] / 2.0) * gridSize).astype(np.int64)
+
+
+def get_nearby_candidates(candidateGrid, cell):
+    """
+    Returns a sorted array of the candidate indices stored in *cell* and its 8 neighbors.
+    """
+    
+    iCandidates = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor = (cell[0] + dx, cell[1] + dy)
+            if neighbor in candidateGrid:
+                iCandidates.extend(candidateGrid[neighbor])
+    return np.array(sorted(iCandidates), dtype=np.int64)
+
+
 def render_bounding_box(detection, inputFileName, outputFileName, lineWidth):
     
-    im = open_image(inputFileName)
-    d = detection.to_api_detection()
-    render_detection_bounding_boxes([d],im,thickness=lineWidth,confidence_threshold=-10)
-    im.save(outputFileName)
+    render_api_detection(detection.to_api_detection(), inputFileName, outputFileName, lineWidth)
+
+
+def get_crop_window(bbox, imWidth, imHeight, cropMargin):
+    """
+    Given a normalized [x,y,w,h] box, returns the pixel window (left, top, right, bottom)
+    around that box, expanded by cropMargin times the box size on each side and clipped
+    to the image, and the same box normalized relative to that window.
+    """
+    
+    x, y, w, h = bbox
+    left = max(0, int(math.floor((x - cropMargin * w) * imWidth)))
+    top = max(0, int(math.floor((y - cropMargin * h) * imHeight)))
+    right = min(imWidth, max(left + 1, int(math.ceil((x + w + cropMargin * w) * imWidth))))
+    bottom = min(imHeight, max(top + 1, int(math.ceil((y + h + cropMargin * h) * imHeight))))
+    
+    cropWidth = right - left
+    cropHeight = bottom - top
+    croppedBbox = [(x * imWidth - left) / cropWidth, (y * imHeight - top) / cropHeight,
+                   w * imWidth / cropWidth, h * imHeight / cropHeight]
+    
+    return (left, top, right, bottom), croppedBbox
+
+
+def load_image_for_rendering(inputFileName, bUseOpenCV=False, maxSize=-1):
+    """
+    Loads an image for draw_api_detection() (as a PIL image) or draw_api_detection_opencv()
+    (as a BGR array).  If *maxSize* is > 0, JPEGs are downscaled by a power of two during
+    decoding, to the smallest size whose shorter side is at least *maxSize* (which is how
+    PIL's draft() chooses a scale).  Boxes are in
+    relative coordinates, so they don't need to be adjusted for the reduced size.
+    """
+    
+    if not bUseOpenCV:
+        im = open_image(inputFileName, draft_size=(maxSize, maxSize) if maxSize > 0 else None)
+        im.load()
+        return im
+    
+    # PIL doesn't apply EXIF rotation, and detector coordinates are relative to the
+    # un-rotated image, so don't let OpenCV apply it either
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if maxSize > 0:
+        # Reading the header to get the image size is cheap
+        with Image.open(inputFileName) as header:
+            shorterSide = min(header.size)
+            bJpeg = header.format == 'JPEG'
+        if bJpeg:
+            for scale, reducedFlags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                        (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if shorterSide / scale >= maxSize:
+                    flags = reducedFlags | cv2.IMREAD_IGNORE_ORIENTATION
+                    break
+    im = cv2.imread(inputFileName, flags)
+    if im is None:
+        raise IOError('Could not read image {}'.format(inputFileName))
+    return im
+
+
+def draw_api_detection(apiDetection, im, lineWidth, cropMargin=-1, bCopy=False):
+    """
+    Draws a single API detection on a PIL image, returning the drawn image.  Draws on *im* 
+    in place unless *bCopy* is set or the image is cropped.
+    """
+    
+    if cropMargin >= 0:
+        window, croppedBbox = get_crop_window(apiDetection['bbox'], im.size[0], im.size[1], cropMargin)
+        im = im.crop(window)
+        apiDetection = dict(apiDetection, bbox=croppedBbox)
+    elif bCopy:
+        im = im.copy()
+    render_detection_bounding_boxes([apiDetection],im,thickness=lineWidth,confidence_threshold=-10)
+    return im
+
+
+def draw_api_detection_opencv(apiDetection, im, lineWidth, cropMargin=-1, bCopy=False):
+    """
+    OpenCV equivalent of draw_api_detection(), for BGR arrays; draws the box, but not the 
+    label.
+    """
+    
+    imHeight, imWidth = im.shape[0:2]
+    
+    bbox = apiDetection['bbox']
+    if cropMargin >= 0:
+        (left, top, right, bottom), bbox = get_crop_window(bbox, imWidth, imHeight, cropMargin)
+        im = im[top:bottom, left:right]
+        imHeight, imWidth = im.shape[0:2]
+    if bCopy:
+        im = im.copy()
+    
+    x, y, w, h = bbox
+    topLeft = (int(round(x * imWidth)), int(round(y * imHeight)))
+    bottomRight = (int(round((x + w) * imWidth)), int(round((y + h) * imHeight)))
+    
+    # Same color selection as draw_bounding_box_on_image()
+    color = COLORS_BGR[int(apiDetection['category']) % len(COLORS_BGR)]
+    cv2.rectangle(im, topLeft, bottomRight, color, lineWidth)
+    return im
+
+
+def save_rendered_image(im, outputFileName):
+    """
+    Writes an image returned by draw_api_detection() or draw_api_detection_opencv().
+    """
+    
+    bWebP = outputFileName.lower().endswith('.webp')
+    if isinstance(im, np.ndarray):
+        if bWebP:
+            params = [cv2.IMWRITE_WEBP_QUALITY, 80]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, 85]
+        if not cv2.imwrite(outputFileName, im, params):
+            raise IOError('Could not write image {}'.format(outputFileName))
+    elif bWebP:
+        im.save(outputFileName, quality=80)
+    else:
+        im.save(outputFileName)
+
+
+def render_api_detection(apiDetection, inputFileName, outputFileName, lineWidth, cropMargin=-1,
+                         bUseOpenCV=False):
+    
+    for im, outputFileName in draw_api_detection_group(
+            [(apiDetection, inputFileName, outputFileName, lineWidth, cropMargin)], bUseOpenCV):
+        save_rendered_image(im, outputFileName)
+
+
+def draw_api_detection_group(renderTasks, bUseOpenCV=False):
+    """
+    Given a list of (apiDetection, inputFileName, outputFileName, lineWidth[, cropMargin
+    [, maxSize]]) tuples that all refer to the same input image, decodes that image once 
+    (using the first task's maxSize) and yields a (drawn image, outputFileName) tuple for 
+    each.
+    """
+    
+    maxSize = renderTasks[0][5] if len(renderTasks[0]) > 5 else -1
+    im = load_image_for_rendering(renderTasks[0][1], bUseOpenCV, maxSize)
+    drawFunction = draw_api_detection_opencv if bUseOpenCV else draw_api_detection
+    
+    # Only copy the decoded image if another task still needs a clean version of it
+    bCopy = len(renderTasks) > 1
+    
+    for renderTask in renderTasks:
+        apiDetection, inputFileName, outputFileName = renderTask[0:3]
+        assert inputFileName == renderTasks[0][1]
+        yield drawFunction(apiDetection, im, *renderTask[3:5], bCopy=bCopy), outputFileName
+
+
+def render_api_detection_groups_task(taskGroups, bUseOpenCV=False):
+    """
+    Renders a list of task groups, each of which is a list of render tasks that all refer
+    to the same input image, for use with executor.submit().
+    """
+    
+    for renderTasks in taskGroups:
+        for im, outputFileName in draw_api_detection_group(renderTasks, bUseOpenCV):
+            save_rendered_image(im, outputFileName)
+
+
+def render_api_detections(renderTasks, options):
+    """
+    Renders a list of (apiDetection, inputFileName, outputFileName, lineWidth[, cropMargin
+    [, maxSize]]) tuples.
+    
+    Decoding, drawing, and encoding are CPU-bound and don't reliably release the GIL, 
+    so if options.bParallelizeRendering is set, we render in worker processes.  We pass
+    API detection dicts rather than DetectionLocation objects to keep pickling cheap.
+    """
+    
+    bUseOpenCV = options.bRenderWithOpenCV and bOpenCVAvailable
+    
+    # Repeat detections frequently share source images, so group tasks by input image 
+    # and decode each image only once
+    tasksByInputFile = {}
+    for renderTask in renderTasks:
+        tasksByInputFile.setdefault(renderTask[1], []).append(renderTask)
+    taskGroups = list(tasksByInputFile.values())
+    
+    # We count progress in images, but only update the progress bar once per group, and 
+    # only redraw it every so often
+    pbar = tqdm(total=len(renderTasks), mininterval=0.5)
+    
+    if options.bParallelizeRendering and options.nWorkers > 1:
+        # Rather than submitting everything up front (as executor.map() does), submit chunks
+        # of groups and keep a bounded number of chunks in flight, so we don't queue up a 
+        # pickled copy of every task at once
+        maxChunksInFlight = 4 * options.nWorkers
+        renderFunction = partial(render_api_detection_groups_task, bUseOpenCV=bUseOpenCV)
+        with ProcessPoolExecutor(max_workers=options.nWorkers) as executor:
+            nImagesPending = {}
+            for iChunk in range(0, len(taskGroups), RENDER_CHUNK_SIZE):
+                chunk = taskGroups[iChunk:iChunk + RENDER_CHUNK_SIZE]
+                future = executor.submit(renderFunction, chunk)
+                nImagesPending[future] = sum([len(taskGroup) for taskGroup in chunk])
+                if len(nImagesPending) >= maxChunksInFlight:
+                    done, _ = wait(nImagesPending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        pbar.update(nImagesPending.pop(future))
+            for future in nImagesPending:
+                future.result()
+                pbar.update(nImagesPending[future])
+    else:
+        # JPEG encoding and file writes do release the GIL, so even when rendering serially, 
+        # we can overlap them with decoding and drawing the next image.  We cap the number 
+        # of images waiting to be written, so we don't hold lots of decoded images in memory.
+        with ThreadPoolExecutor(max_workers=N_ENCODE_THREADS) as encodeExecutor:
+            pending = set()
+            for taskGroup in taskGroups:
+                for im, outputFileName in draw_api_detection_group(taskGroup, bUseOpenCV):
+                    pending.add(encodeExecutor.submit(save_rendered_image, im, outputFileName))
+                    if len(pending) >= 2 * N_ENCODE_THREADS:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                pbar.update(len(taskGroup))
+            for future in pending:
+                future.result()
+    
+    pbar.close()
 
 
 ##%% Look for matches (one directory) (function)
@@ -234,21 +913,29 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
     if options.pbar is not None:
         options.pbar.update()
 
-    # List of DetectionLocations
-    candidateDetections = []
+    candidates = CandidateSet(options.iouThreshold)
 
     rows = rowsByDirectory[dirName]
 
-    # iDirectoryRow = 0; row = rows.iloc[iDirectoryRow]
-    for iDirectoryRow, row in rows.iterrows():
+    # Pull out the columns we need once, rather than materializing a Series per row
+    filenames = rows['file'].to_numpy()
+    maxPs = rows['max_detection_conf'].to_numpy(dtype=np.float64)
+    allDetections = rows['detections'].to_numpy()
 
-        filename = row['file']
-        if not ct_utils.is_image_file(filename):
-            continue
+    # Don't bother checking images with no detections above threshold
+    bAboveThreshold = maxPs >= options.confidenceMin
+
+    # Flatten the detections on the remaining images into (filename, iDetection, detection)
+    # records, so we can apply the per-detection filters to all of them at once.  Pull out
+    # the confidence and area for each detection while we're here.
+    records = []
+    confidences = []
+    areas = []
 
-        # Don't bother checking images with no detections above threshold
-        maxP = float(row['max_detection_conf'])
-        if maxP < options.confidenceMin:
+    # filename = filenames[0]; detections = allDetections[0]
+    for filename, detections in zip(filenames[bAboveThreshold], allDetections[bAboveThreshold]):
+
+        if not ct_utils.is_image_file(filename):
             continue
 
         # Array of dict, where each element is
@@ -258,86 +945,114 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
         #   'bbox': [x_min, y_min, width_of_box, height_of_box]  # (x_min, y_min) is upper-left,
         #                                                           all in relative coordinates and length
         # }
-        detections = row['detections']
         assert len(detections) > 0
 
-        # For each detection in this image
         for iDetection, detection in enumerate(detections):
-            
             assert 'category' in detection and 'conf' in detection and 'bbox' in detection
+            records.append((filename, iDetection, detection))
+            confidences.append(detection['conf'])
+            _, _, w, h = detection['bbox']
+            areas.append(h * w)
 
-            confidence = detection['conf']
-            
-            assert confidence >= 0.0 and confidence <= 1.0
-            if confidence < options.confidenceMin:
-                continue
-            if confidence > options.confidenceMax:
-                continue
-
-            # Optionally exclude some classes from consideration as suspicious
-            if len(options.excludeClasses) > 0:
-                iClass = int(detection['category'])
-                if iClass in options.excludeClasses:
-                    continue
-
-            bbox = detection['bbox']
-            confidence = detection['conf']
-            
-            # Is this detection too big to be suspicious?
-            w, h = bbox[2], bbox[3]
-            area = h * w
+    # ...for each row
 
-            # These are relative coordinates
-            assert area >= 0.0 and area <= 1.0
+    confidences = np.array(confidences, dtype=np.float64)
+    assert ((confidences >= 0.0) & (confidences <= 1.0)).all()
 
-            if area > options.maxSuspiciousDetectionSize:
-                # print('Ignoring very large detection with area {}'.format(area))
-                continue
+    bKeep = (confidences >= options.confidenceMin) & (confidences <= options.confidenceMax)
 
+    # Optionally exclude some classes from consideration as suspicious
+    if len(options.excludeClasses) > 0:
+        # Categories are a handful of repeated strings, so convert each one to an int once
+        categoryToClass = {}
+        for _, _, detection in records:
             category = detection['category']
-            
-            instance = IndexedDetection(iDetection=iDetection,
-                                        filename=row['file'], bbox=bbox, 
-                                        confidence=confidence, category=category)
-
-            bFoundSimilarDetection = False
+            if category not in categoryToClass:
+                categoryToClass[category] = int(category)
+        classes = np.array([categoryToClass[detection['category']] for _, _, detection in records],
+                           dtype=np.int64)
+        bKeep &= ~np.isin(classes, options.excludeClasses)
+
+    # Is each detection too big to be suspicious?  These are relative coordinates.
+    areas = np.array(areas, dtype=np.float64)
+    assert ((areas[bKeep] >= 0.0) & (areas[bKeep] <= 1.0)).all()
+
+    bKeep &= (areas <= options.maxSuspiciousDetectionSize)
+
+    iKeep = np.flatnonzero(bKeep)
+
+    # Convert all the surviving boxes to corners, areas, and grid cells as (N,4) and (N,2)
+    # blocks, rather than one box at a time.  We convert the results back to lists, since 
+    # we use them one box at a time below, and Python floats are cheaper to work with 
+    # individually than NumPy scalars.
+    bboxes = np.array([records[iRecord][2]['bbox'] for iRecord in iKeep], 
+                      dtype=np.float64).reshape(-1, 4)
+    xyxys, keptAreas = get_xyxy_and_area_many(bboxes)
+    xyxys = xyxys.tolist()
+    keptAreas = keptAreas.tolist()
+    cells = [tuple(cell) for cell in get_grid_cells(bboxes, candidates.gridSize).tolist()]
+
+    # Look these up once, rather than once per detection
+    bAllowMultiMatch = options.bAllowMultiMatch
+    find_matches = candidates.find_matches
+    add_instance = candidates.add_instance
+
+    # For each detection that survived filtering, in order
+    for iKept, iRecord in enumerate(iKeep):
+
+        filename, iDetection, detection = records[iRecord]
+
+        bbox = detection['bbox']
+        confidence = detection['conf']
+        category = detection['category']
+
+        instance = IndexedDetection(iDetection=iDetection,
+                                    filename=filename, bbox=bbox, 
+                                    confidence=confidence, category=category)
+
+        # Compare this detection to every nearby detection in our candidate list at once
+        iMatches = find_matches(xyxys[iKept], keptAreas[iKept], cells[iKept])
+
+        # Optionally allow this instance to match multiple candidates.  There isn't an 
+        # obvious right or wrong here, but at high IoU thresholds multiple matches are 
+        # rare, and in a burst of images the location we matched last time is almost 
+        # always the right one.
+        if len(iMatches) > 1 and not bAllowMultiMatch:
+            iMatches = [candidates.most_recent(iMatches)]
+
+        for iCandidate in iMatches:
+            add_instance(iCandidate, instance)
+
+        # If we found no matches, add this to the candidate list
+        if len(iMatches) == 0:
+            candidates.add(instance, detection, xyxys[iKept], keptAreas[iKept], cells[iKept])
 
-            # For each detection in our candidate list
-            for iCandidate, candidate in enumerate(candidateDetections):
-
-                # Is this a match?                    
-                iou = ct_utils.get_iou(bbox, candidate.bbox)
-
-                if iou >= options.iouThreshold:
-                    
-                    bFoundSimilarDetection = True
-
-                    # If so, add this example to the list for this detection
-                    candidate.instances.append(instance)
-
-                    # We *don't* break here; we allow this instance to possibly
-                    # match multiple candidates.  There isn't an obvious right or
-                    # wrong here.
-
-            # ...for each detection on our candidate list
-
-            # If we found no matches, add this to the candidate list
-            if not bFoundSimilarDetection:
-                candidate = DetectionLocation(instance, detection, dirName)
-                candidateDetections.append(candidate)
+    # ...for each detection
 
-        # ...for each detection
+    # Return a list of DetectionLocations
+    return candidates.to_detection_locations(dirName)
 
-    # ...for each row
+# ...def find_matches_in_directory(dirName)
 
-    return candidateDetections
 
-# ...def find_matches_in_directory(dirName)
+def find_matches_in_directories(dirNames, options, rowsByDirectory):
+    """
+    Runs find_matches_in_directory() on each directory in *dirNames*, returning a list of
+    candidate lists in the same order.  Used to hand each worker process a whole chunk
+    of directories at once.
+    """
+    
+    return [find_matches_in_directory(dirName, options, rowsByDirectory) for dirName in dirNames]
 
     
 ##%% Render problematic locations to html (function)
 
-def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections, options):
+def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections, options, renderTasks):
+    """
+    Writes the html pages for one directory.  Rather than rendering images here, appends
+    (apiDetection, inputFileName, outputFileName, lineWidth) tuples to *renderTasks*, to 
+    be rendered in bulk by render_api_detections().
+    """
     
     nDirs = len(directoryHtmlFiles)
 
@@ -388,7 +1103,9 @@ def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
 
         imageInfo = []
 
-        # Render images
+        apiDetection = detection.to_api_detection()
+
+        # Queue images for rendering
 
         # iInstance = 0; instance = detection.instances[iInstance]
         for iInstance, instance in enumerate(detection.instances):
@@ -407,14 +1124,19 @@ def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
             thisImageInfo['title'] = t
             imageInfo.append(thisImageInfo)
 
+            # Instances of a detection are spread across the files in a directory (and not 
+            # necessarily sorted), so check existence against a cached directory listing 
+            # rather than stat'ing each file.  Names that aren't in the listing may still
+            # exist with different case on case-insensitive file systems, so we stat those.
             inputFileName = os.path.join(options.imageBase, instance.filename)
-            if not os.path.isfile(inputFileName):
+            if (os.path.basename(inputFileName) not in list_files_in_dir(os.path.dirname(inputFileName))) \
+                    and (not os.path.isfile(inputFileName)):
                 if options.bPrintMissingImageWarnings:
                     if (options.missingImageWarningType == 'all') or (not bPrintedMissingImageWarning):
                         print('Warning: could not find file {}'.format(inputFileName))
                         bPrintedMissingImageWarning = True
             else:
-                render_bounding_box(detection, inputFileName, imageOutputFilename, 15)
+                renderTasks.append((apiDetection, inputFileName, imageOutputFilename, 15))
 
         # ...for each instance
 
@@ -466,36 +1188,25 @@ def update_detection_table(RepeatDetectionResults, options, outputFilename=None)
 
     print('Updating output table')
 
+    # Collect every instance we need to modify, so we can look up all of their rows at once
+    instancesToModify = []
+
     # For each suspicious detection (two loops)
     for iDir, directoryEvents in enumerate(suspiciousDetectionsByDirectory):
 
         for iDetectionEvent, detectionEvent in enumerate(directoryEvents):
 
-            locationBbox = detectionEvent.bbox
-
             for iInstance, instance in enumerate(detectionEvent.instances):
 
-                instanceBbox = instance.bbox
-
-                # This should match the bbox for the detection event
-                iou = ct_utils.get_iou(instanceBbox, locationBbox)
-                # There are instances where iou is very close to the threshold so cannot use >
-                assert iou >= options.iouThreshold
-
-                assert instance.filename in RepeatDetectionResults.filenameToRow
-                iRow = RepeatDetectionResults.filenameToRow[instance.filename]
-                row = detectionResults.iloc[iRow]
-                rowDetections = row['detections']
-                detectionToModify = rowDetections[instance.iDetection]
-
-                # Make sure the bounding box matches
-                assert (instanceBbox[0:3] == detectionToModify['bbox'][0:3])
+                # The bbox for each instance should match the bbox for the detection
+                # event; this was established when we matched them, so we only re-check 
+                # it on request.
+                if __debug__ and options.bVerifyIou:
+                    iou = ct_utils.get_iou(instance.bbox, detectionEvent.bbox)
+                    # There are instances where iou is very close to the threshold so cannot use >
+                    assert iou >= options.iouThreshold
 
-                # Make the probability negative, if it hasn't been switched by
-                # another bounding box
-                if detectionToModify['conf'] >= 0:
-                    detectionToModify['conf'] = -1 * detectionToModify['conf']
-                    nBboxChanges += 1
+                instancesToModify.append(instance)
 
             # ...for each instance
 
@@ -503,40 +1214,56 @@ def update_detection_table(RepeatDetectionResults, options, outputFilename=None)
 
     # ...for each directory       
 
+    rowIndices = RepeatDetectionResults.filenameToRow.get_indexer(
+        [instance.filename for instance in instancesToModify])
+    assert (rowIndices >= 0).all()
+
+    # An object array of references to each row's list of detection dicts; indexing this
+    # is much cheaper than going through pandas for every instance
+    detectionsColumn = detectionResults['detections'].to_numpy()
+
+    for instance, iRow in zip(instancesToModify, rowIndices):
+
+        rowDetections = detectionsColumn[iRow]
+        detectionToModify = rowDetections[instance.iDetection]
+
+        # Make sure the bounding box matches
+        assert (instance.bbox[0:3] == detectionToModify['bbox'][0:3])
+
+        # Make the probability negative, if it hasn't been switched by
+        # another bounding box
+        if detectionToModify['conf'] >= 0:
+            detectionToModify['conf'] = -1 * detectionToModify['conf']
+            nBboxChanges += 1
+
+    # ...for each instance
+
     # Update maximum probabilities
 
-    # For each row...
+    # Only rows where we flipped at least one detection can have a new maximum, so
+    # rather than re-scanning the whole table, visit each of those rows once.
     nProbChanges = 0
     nProbChangesToNegative = 0
     nProbChangesAcrossThreshold = 0
 
-    for iRow, row in detectionResults.iterrows():
-
-        detections = row['detections']
-        if len(detections) == 0:
-            continue
-
-        maxPOriginal = float(row['max_detection_conf'])
-        assert maxPOriginal >= 0
+    maxPs = detectionResults['max_detection_conf'].to_numpy(dtype=np.float64, copy=True)
 
-        maxP = None
-        nNegative = 0
+    # iRow = rowIndices[0]
+    for iRow in np.unique(rowIndices):
 
-        for iDetection, detection in enumerate(detections):
-            p = detection['conf']
+        detections = detectionsColumn[iRow]
 
-            if p < 0:
-                nNegative += 1
+        maxPOriginal = maxPs[iRow]
+        assert maxPOriginal >= 0
 
-            if (maxP is None) or (p > maxP):
-                maxP = p
+        confidences = [detection['conf'] for detection in detections]
+        maxP = max(confidences)
 
         if abs(maxP - maxPOriginal) > 0.00000001:
 
             # We should only be making detections *less* likely
             assert maxP < maxPOriginal
-            # row['max_confidence'] = str(maxP)
-            detectionResults.at[iRow, 'max_detection_conf'] = maxP
+            maxPs[iRow] = maxP
 
             nProbChanges += 1
 
@@ -548,12 +1275,14 @@ def update_detection_table(RepeatDetectionResults, options, outputFilename=None)
 
             # Negative probabilities should be the only reason maxP changed, so
             # we should have found at least one negative value
-            assert nNegative > 0
+            assert min(confidences) < 0
 
         # ...if there was a change to the max probability for this row
 
     # ...for each row
 
+    detectionResults['max_detection_conf'] = maxPs
+
     if outputFilename is not None:
         write_api_results(detectionResults, RepeatDetectionResults.otherFields, outputFilename)
 
@@ -586,46 +1315,37 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
     toReturn.detectionResults = detectionResults
     toReturn.otherFields = otherFields
 
+    # Filenames are unique, so a categorical wouldn't save anything here, but Arrow-backed
+    # strings store them in one buffer rather than as one Python object per row.  This is
+    # already the default for pandas >= 3.0; requires pyarrow.
+    try:
+        detectionResults['file'] = detectionResults['file'].astype('string[pyarrow]')
+    except (ImportError, TypeError):
+        pass
 
-    ##%% Separate files into directories
 
-    # This will be a map from a directory name to smaller data frames
-    rowsByDirectory = {}
-
-    # This is a mapping back into the rows of the original table
-    filenameToRow = {}
+    ##%% Separate files into directories
 
     # TODO: in the case where we're loading an existing set of FPs after manual filtering,
     # we should load these data frames too, rather than re-building them from the input.
 
     print('Separating files into directories...')
 
-    # iRow = 0; row = detectionResults.iloc[0]
-    for iRow, row in detectionResults.iterrows():
-        relativePath = row['file']
-        dirName = os.path.dirname(relativePath)
-
-        if options.nDirLevelsFromLeaf > 0:
-            iLevel = 0
-            while (iLevel < options.nDirLevelsFromLeaf):
-                iLevel += 1
-                dirName = os.path.dirname(dirName)
-        assert len(dirName) > 0
-
-        if not dirName in rowsByDirectory:
-            # Create a new DataFrame with just this row
-            # rowsByDirectory[dirName] = pd.DataFrame(row)
-            rowsByDirectory[dirName] = []
-
-        rowsByDirectory[dirName].append(row)
+    # Paths have been normalized by load_api_results(), so os.sep is the only separator.
+    # Strip off the filename, plus nDirLevelsFromLeaf more levels.
+    files = detectionResults['file']
+    nLevelsToStrip = 1 + options.nDirLevelsFromLeaf
+    assert (files.str.count(re.escape(os.sep)) >= nLevelsToStrip).all()
+    dirNames = files.str.rsplit(os.sep, n=nLevelsToStrip).str[0]
+    assert (dirNames.str.len() > 0).all()
 
-        assert relativePath not in filenameToRow
-        filenameToRow[relativePath] = iRow
+    # This will be a map from a directory name to smaller data frames; sort=False keeps
+    # directories in the order in which they first appear
+    rowsByDirectory = {dirName: rows for dirName, rows in detectionResults.groupby(dirNames, sort=False)}
 
-    # Convert lists of rows to proper DataFrames
-    dirs = list(rowsByDirectory.keys())
-    for d in dirs:
-        rowsByDirectory[d] = pd.DataFrame(rowsByDirectory[d])
+    # This is a mapping back into the rows of the original table
+    filenameToRow = pd.Index(detectionResults['file'])
+    assert filenameToRow.is_unique
 
     toReturn.rowsByDirectory = rowsByDirectory
     toReturn.filenameToRow = filenameToRow
@@ -658,9 +1378,21 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
 
         else:
 
-            options.pbar = tqdm(total=len(dirsToSearch))
-            allCandidateDetections = Parallel(n_jobs=options.nWorkers, prefer='threads')(
-                delayed(find_matches_in_directory)(dirName, options, rowsByDirectory) for dirName in tqdm(dirsToSearch))
+            # The comparisons are CPU-bound Python, so we use processes rather than threads.
+            # Each worker gets a contiguous chunk of directories, and only the rows for those
+            # directories, to keep the amount of data we pickle down.
+            #
+            # A progress bar can't be shared across processes.
+            options.pbar = None
+            nChunks = max(1, min(options.nWorkers, len(dirsToSearch)))
+            chunkSize = int(np.ceil(len(dirsToSearch) / nChunks))
+            dirChunks = [dirsToSearch[i:i + chunkSize] for i in range(0, len(dirsToSearch), chunkSize)]
+
+            chunkResults = Parallel(n_jobs=options.nWorkers, backend='loky')(
+                delayed(find_matches_in_directories)(dirChunk, options,
+                                                     {dirName: rowsByDirectory[dirName] for dirName in dirChunk})
+                for dirChunk in tqdm(dirChunks))
+            allCandidateDetections = [candidates for chunk in chunkResults for candidates in chunk]
 
         print('\nFinished looking for similar bounding boxes')
 
@@ -676,25 +1408,19 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
         # iDir = 51
         for iDir in range(len(dirsToSearch)):
 
-            # A list of DetectionLocation objects
-            suspiciousDetectionsThisDir = []
-
             # A list of DetectionLocation objects
             candidateDetectionsThisDir = allCandidateDetections[iDir]
 
-            for iLocation, candidateLocation in enumerate(candidateDetectionsThisDir):
-
-                # occurrenceList is a list of file/detection pairs
-                nOccurrences = len(candidateLocation.instances)
-
-                if nOccurrences < options.occurrenceThreshold:
-                    continue
+            # The number of file/detection pairs for each location
+            nOccurrences = np.array([len(candidateLocation.instances)
+                                     for candidateLocation in candidateDetectionsThisDir], dtype=np.int64)
+            bSuspicious = nOccurrences >= options.occurrenceThreshold
 
-                nImagesWithSuspiciousDetections += nOccurrences
-                nSuspiciousDetections += 1
+            nImagesWithSuspiciousDetections += int(nOccurrences[bSuspicious].sum())
+            nSuspiciousDetections += int(bSuspicious.sum())
 
-                suspiciousDetectionsThisDir.append(candidateLocation)
-                # Find the images corresponding to this bounding box, render boxes
+            # A list of DetectionLocation objects
+            suspiciousDetectionsThisDir = list(compress(candidateDetectionsThisDir, bSuspicious))
 
             suspiciousDetections[iDir] = suspiciousDetectionsThisDir
 
@@ -707,9 +1433,7 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
         print('Bypassing detection-finding, loading from {}'.format(options.filterFileToLoad))
 
         # Load the filtering file
-        detectionIndexFileName = options.filterFileToLoad
-        sIn = open(detectionIndexFileName, 'r').read()
-        suspiciousDetections = jsonpickle.decode(sIn)
+        suspiciousDetections = load_detection_index(options.filterFileToLoad)
         filteringBaseDir = os.path.dirname(options.filterFileToLoad)
         assert len(suspiciousDetections) == len(dirsToSearch)
 
@@ -723,9 +1447,17 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
             with open(options.filteredFileListToLoad) as f:
                 fileList = f.readlines()
                 fileList = [x.strip() for x in fileList]
+                # We only use this for membership tests
+                fileList = set(fileList)
             nSuspiciousDetections = sum([len(x) for x in suspiciousDetections])
             print('Loaded false positive list from file, will remove {} of {} suspicious detections'.format(
                 len(fileList), nSuspiciousDetections))
+        else:
+            # Which sample images are still there?  Listing the filtering folder once is much 
+            # cheaper than stat'ing each sample image, especially on network shares.
+            existingFiles = find_existing_files(filteringBaseDir,
+                [detection.sampleImageRelativeFileName for detections in suspiciousDetections
+                 for detection in detections])
 
         # For each directory
         # iDir = 0; detections = suspiciousDetections[0]
@@ -742,11 +1474,9 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
                 # or reading from a list?
                 if fileList is None:
                     
-                    # Is the image still there?                
-                    imageFullPath = os.path.join(filteringBaseDir, detection.sampleImageRelativeFileName)
-
-                    # If not, remove this from the list of suspicious detections
-                    if not os.path.isfile(imageFullPath):
+                    # Is the image still there?  If not, remove this from the list of 
+                    # suspicious detections.
+                    if detection.sampleImageRelativeFileName not in existingFiles:
                         nDetectionsRemoved += 1
                         bValidDetection[iDetection] = False
 
@@ -783,27 +1513,24 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
         nDirs = len(dirsToSearch)
         directoryHtmlFiles = [None] * nDirs
 
-        if options.bParallelizeRendering:
-
-            # options.pbar = tqdm(total=nDirs)
-            options.pbar = None
+        # Writing html is cheap, so we do that serially, and collect the images that need
+        # rendering into one flat list we can hand to a process pool.
+        options.pbar = None
+        renderTasks = []
 
-            directoryHtmlFiles = Parallel(n_jobs=options.nWorkers, prefer='threads')(delayed(
-                render_images_for_directory)(iDir, directoryHtmlFiles, suspiciousDetections, options) for iDir in
-                                                                                     tqdm(range(nDirs)))
-
-        else:
+        # For each directory
+        # iDir = 51
+        for iDir in range(nDirs):
+            # Add this directory to the master list of html files
+            directoryHtmlFiles[iDir] = render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
+                                                                   options, renderTasks)
 
-            options.pbar = None
+        # ...for each directory
 
-            # For each directory
-            # iDir = 51
-            for iDir in range(nDirs):
-                # Add this directory to the master list of html files
-                directoryHtmlFiles[iDir] = render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections,
-                                                                       options)
+        list_files_in_dir.cache_clear()
 
-            # ...for each directory
+        print('Rendering {} images'.format(len(renderTasks)))
+        render_api_detections(renderTasks, options)
 
         # Write master html file
 
@@ -845,8 +1572,41 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
         filteringDir = os.path.join(options.outputBase, 'filtering_' + dateString)
         os.makedirs(filteringDir, exist_ok=True)
 
-        # iDir = 0; suspiciousDetectionsThisDir = suspiciousDetections[iDir]
-        for iDir, suspiciousDetectionsThisDir in enumerate(tqdm(suspiciousDetections)):
+        # The debug limits on rendering apply here too, and are applied before we do any 
+        # work for a detection.  Detections we don't render are left out of the detection 
+        # index (which still has one list per directory), so they're never treated as false
+        # positives when the index is loaded.
+        renderedDetections = []
+        for iDir, suspiciousDetectionsThisDir in enumerate(suspiciousDetections):
+            if options.debugMaxRenderDir > 0 and iDir > options.debugMaxRenderDir:
+                suspiciousDetectionsThisDir = []
+            elif options.debugMaxRenderDetection > 0:
+                suspiciousDetectionsThisDir = suspiciousDetectionsThisDir[0:options.debugMaxRenderDetection + 1]
+            renderedDetections.append(suspiciousDetectionsThisDir)
+        
+        # Make sure all the source images are there, listing each image directory once
+        existingImages = find_existing_files(options.imageBase,
+            [detection.instances[0].filename for detections in renderedDetections
+             for detection in detections])
+        
+        # Collect one sample image per suspicious detection into a flat list we can hand
+        # to a process pool, along with the sample image name for each detection, which we 
+        # record once rendering is done
+        renderTasks = []
+        sampleImageNames = []
+        
+        # Join path prefixes once, rather than calling os.path.join() per detection, and
+        # pull options we use per detection into locals
+        imageBasePrefix = os.path.join(options.imageBase, '')
+        filteringDirPrefix = os.path.join(filteringDir, '')
+        cropMargin = options.sampleImageCropMargin
+        maxSize = options.sampleImageMaxSize
+        assert options.sampleImageFormat in ('jpg', 'webp'), \
+            'Unsupported sample image format: {}'.format(options.sampleImageFormat)
+        sampleImageNameFormat = 'dir{:0>4d}_det{:0>4d}.' + options.sampleImageFormat
+
+        # iDir = 0; suspiciousDetectionsThisDir = renderedDetections[iDir]
+        for iDir, suspiciousDetectionsThisDir in enumerate(renderedDetections):
 
             # suspiciousDetectionsThisDir is a list of DetectionLocation objects
             # iDetection = 0; detection = suspiciousDetectionsThisDir[0]
@@ -854,19 +1614,23 @@ def find_repeat_detections(inputFilename, outputFilename, options=None):
                 
                 instance = detection.instances[0]
                 relativePath = instance.filename
-                inputFullPath = os.path.join(options.imageBase, relativePath)
-                assert (os.path.isfile(inputFullPath)), 'Not a file: {}'.format(inputFullPath)
-                outputRelativePath = 'dir{:0>4d}_det{:0>4d}.jpg'.format(iDir, iDetection)
-                outputFullPath = os.path.join(filteringDir, outputRelativePath)
-                render_bounding_box(detection, inputFullPath, outputFullPath, 15)
-                detection.sampleImageRelativeFileName = outputRelativePath
+                inputFullPath = imageBasePrefix + relativePath
+                assert relativePath in existingImages, 'Not a file: {}'.format(inputFullPath)
+                outputRelativePath = sampleImageNameFormat.format(iDir, iDetection)
+                outputFullPath = filteringDirPrefix + outputRelativePath
+                renderTasks.append((detection.to_api_detection(), inputFullPath, outputFullPath, 15,
+                                    cropMargin, maxSize))
+                sampleImageNames.append((detection, outputRelativePath))
+
+        print('Rendering {} sample images'.format(len(renderTasks)))
+        render_api_detections(renderTasks, options)
+
+        for detection, outputRelativePath in sampleImageNames:
+            detection.sampleImageRelativeFileName = outputRelativePath
 
         # Write out the detection index
         detectionIndexFileName = os.path.join(filteringDir, 'detectionIndex.json')
-        jsonpickle.set_encoder_options('json', sort_keys=True, indent=4)
-        s = jsonpickle.encode(suspiciousDetections)
-        with open(detectionIndexFileName, 'w') as f:
-            f.write(s)
+        write_detection_index(renderedDetections, detectionIndexFileName)
         toReturn.filterFile = detectionIndexFileName
 
         print('Done')
@@ -956,6 +1720,9 @@ def main():
     parser.add_argument('--occurrenceThreshold', action='store', type=int,
                         default=defaultOptions.occurrenceThreshold,
                         help='More than this many near-identical detections in a group (e.g. a folder) is considered suspicious')
+    parser.add_argument('--allowMultiMatch', action='store_true',
+                        dest='bAllowMultiMatch',
+                        help='Allow a single detection to count toward multiple suspicious locations')
     parser.add_argument('--nWorkers', action='store', type=int,
                         default=defaultOptions.nWorkers,
                         help='Level of parallelism for rendering and IOU computation')
@@ -963,6 +1730,18 @@ def main():
                         default=defaultOptions.maxSuspiciousDetectionSize,
                         help='Detections larger than this fraction of image area are not considered suspicious')
 
+    parser.add_argument('--sampleImageCropMargin', action='store', type=float,
+                        default=defaultOptions.sampleImageCropMargin,
+                        help='Crop filtering folder images to each detection, plus this fraction of the detection size on each side (-1 to write full images)')
+
+    parser.add_argument('--sampleImageFormat', action='store', type=str,
+                        default=defaultOptions.sampleImageFormat, choices=['jpg', 'webp'],
+                        help='Image format for filtering folder images')
+
+    parser.add_argument('--sampleImageMaxSize', action='store', type=int,
+                        default=defaultOptions.sampleImageMaxSize,
+                        help='Decode filtering folder JPEGs at reduced resolution, down to this many pixels on the shorter side (-1 for full resolution)')
+
     parser.add_argument('--renderHtml', action='store_true',
                         dest='bRenderHtml', help='Should we render HTML output?')
     parser.add_argument('--omitFilteringFolder', action='store_false',
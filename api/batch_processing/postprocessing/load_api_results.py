@@ -9,15 +9,36 @@
 #%% Constants and imports
 
 import pandas as pd
+import numpy as np
 import json
 import os
+import gc
+
+# orjson is optional, but parses large API output files several times faster than json
+try:
+    import orjson
+    b_orjson_available = True
+except ImportError:
+    b_orjson_available = False
+
+# pyarrow is optional, and only needed to cache API results as parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    b_pyarrow_available = True
+except ImportError:
+    b_pyarrow_available = False
 
 headers = ['image_path', 'max_confidence', 'detections']
 
+# Appended to the API output filename to get the name of the parquet cache
+PARQUET_CACHE_EXTENSION = '.parquet'
+
 
 #%% Functions
 
-def load_api_results(api_output_filename, normalize_paths=True, filename_replacements={}):
+def load_api_results(api_output_filename, normalize_paths=True, filename_replacements={},
+                     use_parquet_cache=False):
     """
     Loads the json formatted results from the batch processing API to a Pandas DataFrame, mainly useful for
     various postprocessing functions.
@@ -26,6 +47,9 @@ def load_api_results(api_output_filename, normalize_paths=True, filename_replace
         api_output_filename: path to the API output json file
         normalize_paths: whether to apply os.path.normpath to the 'file' field in each image entry in the output file
         filename_replacements: replace some path tokens to match local paths to the original blob structure
+        use_parquet_cache: whether to cache the parsed results in a parquet file next to the API output file
+            (api_output_filename + '.parquet'), and to load from that cache instead of the json file when it's
+            newer than the json file; requires pyarrow
 
     Returns:
         detection_results: a Pandas DataFrame with columns (file, max_detection_conf, detections)
@@ -34,30 +58,63 @@ def load_api_results(api_output_filename, normalize_paths=True, filename_replace
         other_fields: a dict containing fields in the dict
     """
     
-    print('Loading API results from {}'.format(api_output_filename))
-
-    with open(api_output_filename) as f:
-        detection_results = json.load(f)
-
-    print('De-serializing API results from {}'.format(api_output_filename))
-
-    # Sanity-check that this is really a detector output file
-    for s in ['info', 'detection_categories', 'images']:
-        assert s in detection_results
-
-    # Fields in the API output json other than 'images'
-    other_fields = {}  
-    for k, v in detection_results.items():
-        if k != 'images':
-            other_fields[k] = v
+    if use_parquet_cache and not b_pyarrow_available:
+        print('Warning: pyarrow is not available, not caching API results')
+        use_parquet_cache = False
+        
+    cache_filename = api_output_filename + PARQUET_CACHE_EXTENSION
+    detection_results = None
+    
+    if use_parquet_cache and os.path.isfile(cache_filename) and \
+            os.path.getmtime(cache_filename) >= os.path.getmtime(api_output_filename):
+        print('Loading API results from cache {}'.format(cache_filename))
+        try:
+            detection_results, other_fields = read_api_results_parquet(cache_filename)
+        except Exception as e:
+            print('Warning: could not read cached API results from {}: {}'.format(cache_filename, str(e)))
+            
+    if detection_results is None:
+        
+        print('Loading API results from {}'.format(api_output_filename))
+    
+        if b_orjson_available:
+            with open(api_output_filename, 'rb') as f:
+                try:
+                    detection_results = orjson.loads(f.read())
+                except orjson.JSONDecodeError:
+                    # orjson is stricter than json, e.g. it doesn't accept the NaN 
+                    # values json.dump writes by default
+                    pass
+        if detection_results is None:
+            with open(api_output_filename) as f:
+                detection_results = json.load(f)
+    
+        print('De-serializing API results from {}'.format(api_output_filename))
+    
+        # Sanity-check that this is really a detector output file
+        for s in ['info', 'detection_categories', 'images']:
+            assert s in detection_results
+    
+        # Fields in the API output json other than 'images'
+        other_fields = {}  
+        for k, v in detection_results.items():
+            if k != 'images':
+                other_fields[k] = v
+                
+        # Pack the json output into a Pandas DataFrame
+        detection_results = pd.DataFrame(detection_results['images'])
+        
+        # The cache holds the results before path normalization and replacement, so it 
+        # doesn't depend on those options
+        if use_parquet_cache:
+            try:
+                write_api_results_parquet(detection_results, other_fields, cache_filename)
+            except Exception as e:
+                print('Warning: could not cache API results to {}: {}'.format(cache_filename, str(e)))
 
     # Normalize paths to simplify comparisons later
     if normalize_paths:
-        for image in detection_results['images']:
-            image['file'] = os.path.normpath(image['file'])
-
-    # Pack the json output into a Pandas DataFrame
-    detection_results = pd.DataFrame(detection_results['images'])
+        detection_results['file'] = [os.path.normpath(fn) for fn in detection_results['file']]
 
     # Optionally replace some path tokens to match local paths to the original blob structure
     # string_to_replace = list(options.detector_output_filename_replacements.keys())[0]
@@ -65,16 +122,11 @@ def load_api_results(api_output_filename, normalize_paths=True, filename_replace
 
         replacement_string = filename_replacements[string_to_replace]
 
-        # TODO: hit some silly issues with vectorized str() and escaped characters, vectorize
-        # this later.
-        #
-        # detection_results['image_path'].str.replace(string_to_replace,replacement_string)
-        # i_row = 0
-        for i_row in range(0, len(detection_results)):
-            row = detection_results.iloc[i_row]
-            fn = row['file']
-            fn = fn.replace(string_to_replace, replacement_string)
-            detection_results.at[i_row, 'file'] = fn
+        # Use plain str.replace rather than the vectorized .str.replace, which hit some silly
+        # issues with escaped characters; this is still one pass over a numpy view of the 
+        # column, rather than an .iloc lookup per row
+        detection_results['file'] = [fn.replace(string_to_replace, replacement_string)
+                                     for fn in detection_results['file'].to_numpy()]
 
     print('Finished loading and de-serializing API results for {} images from {}'.format(len(detection_results),
                                                                                          api_output_filename))
@@ -82,6 +134,191 @@ def load_api_results(api_output_filename, normalize_paths=True, filename_replace
     return detection_results, other_fields
 
 
+def write_api_results_parquet(detection_results, other_fields, out_path):
+    """
+    Writes a DataFrame in the format returned by load_api_results, and the associated
+    other_fields dict, to a parquet file that read_api_results_parquet can load.
+    
+    Detections are stored as lists of structs, so they're stored column-wise like 
+    everything else; since Arrow lists can't mix types, each [category, conf] 
+    classification pair is stored as a {'category', 'conf'} struct.
+    """
+    
+    def detection_to_arrow(det):
+        if 'classifications' not in det:
+            return det
+        det = dict(det)
+        det['classifications'] = [{'category': c[0], 'conf': c[1]} for c in det['classifications']]
+        return det
+    
+    detections = [None if not isinstance(detections, list) else 
+                  [detection_to_arrow(det) for det in detections]
+                  for detections in detection_results['detections']]
+    
+    i_detections_column = list(detection_results.columns).index('detections')
+    table = pa.Table.from_pandas(detection_results.drop(columns=['detections']), preserve_index=False)
+    table = table.add_column(i_detections_column, 'detections', pa.array(detections))
+    
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'other_fields'] = json.dumps(other_fields).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+    
+    # Write to a temporary file first, so an interrupted write never leaves a cache
+    # that looks valid
+    tmp_path = out_path + '.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, out_path)
+
+
+def read_api_results_parquet(parquet_filename):
+    """
+    Reads a parquet file written by write_api_results_parquet.  
+    
+    Returns:
+        detection_results, other_fields, in the same format as load_api_results
+    """
+    
+    table = pq.read_table(parquet_filename, memory_map=True)
+    other_fields = json.loads(table.schema.metadata[b'other_fields'])
+    
+    detection_results = table.drop(['detections']).to_pandas()
+    
+    # We're about to allocate lots of small containers, none of which can be part of a
+    # reference cycle; don't let the cyclic garbage collector repeatedly scan them
+    b_gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        detection_results.insert(table.schema.get_field_index('detections'), 'detections',
+                                 _detections_from_arrow(table.column('detections').combine_chunks()))
+    finally:
+        if b_gc_enabled:
+            gc.enable()
+    
+    return detection_results, other_fields
+
+
+def _detections_from_arrow(detections_column):
+    """
+    Converts the Arrow 'detections' column written by write_api_results_parquet back 
+    to a list of per-image detection lists (None for images without a detections list).
+    """
+    
+    # Rebuild the detection dicts from the flattened struct fields, one field at a time,
+    # which is much faster than converting each struct to a dict and fixing it up.
+    # Arrow fills in fields that are missing from some structs as nulls; we leave those
+    # out, so we get back the original dicts.
+    flat_detections = detections_column.flatten()
+    detections = [{} for _ in range(len(flat_detections))]
+    
+    for i_field in range(flat_detections.type.num_fields):
+        
+        field_name = flat_detections.type.field(i_field).name
+        field_values = flat_detections.field(i_field)
+        
+        if field_name == 'classifications':
+            # Convert {'category', 'conf'} structs back to [category, conf] pairs
+            classification_offsets = field_values.offsets.to_numpy()
+            classification_offsets = (classification_offsets - classification_offsets[0]).tolist()
+            flat_classifications = field_values.flatten()
+            classification_pairs = [[category, conf] for category, conf in 
+                                    zip(flat_classifications.field('category').to_pylist(),
+                                        flat_classifications.field('conf').to_pylist())]
+            values = [classification_pairs[classification_offsets[i]:classification_offsets[i+1]]
+                      for i in range(len(field_values))]
+        else:
+            values = field_values.to_pylist()
+            
+        if field_values.null_count == 0:
+            for det, value in zip(detections, values):
+                det[field_name] = value
+        else:
+            for i_det in np.flatnonzero(field_values.is_valid().to_numpy(zero_copy_only=False)):
+                detections[i_det][field_name] = values[i_det]
+                
+    # ...for each detection field
+    
+    image_offsets = detections_column.offsets.to_numpy()
+    image_offsets = (image_offsets - image_offsets[0]).tolist()
+    b_has_detections = detections_column.is_valid().to_numpy(zero_copy_only=False)
+    
+    return [detections[image_offsets[i]:image_offsets[i+1]] if b_has_detections[i] else None
+            for i in range(len(detections_column))]
+
+
+class DetectionArrays:
+    """
+    The per-detection fields of a 'detections' column, flattened into parallel numpy
+    arrays (one element per detection), so they can be processed with array operations
+    rather than by probing each detection dict.  The detections for image i are
+    elements image_start[i]:image_start[i+1] of each per-detection array.
+
+    Category and classification IDs are stored as small integer codes; the original 
+    IDs are category_ids[code] and classification_category_ids[code].  Detections 
+    without classification results have a classification code of -1 and a 
+    classification confidence of nan.
+    """
+
+    def __init__(self):
+        
+        self.image_start = None
+        self.image_index = None
+        self.conf = None
+        self.bbox = None
+        self.category = None
+        self.category_ids = []
+        self.classification_category = None
+        self.classification_conf = None
+        self.classification_category_ids = []
+
+
+def detections_to_arrays(detections_column):
+    """
+    Flattens a sequence of per-image detection lists (e.g. the 'detections' column 
+    returned by load_api_results) into a DetectionArrays object.
+    """
+    
+    category_to_code = {}
+    classification_category_to_code = {}
+    
+    n_detections_per_image = []
+    conf = []
+    bbox = []
+    category = []
+    classification_category = []
+    classification_conf = []
+    
+    for detections in detections_column:
+        n_detections_per_image.append(len(detections))
+        for det in detections:
+            conf.append(det['conf'])
+            bbox.append(det['bbox'])
+            category.append(category_to_code.setdefault(det['category'], len(category_to_code)))
+            if 'classifications' in det:
+                top1 = det['classifications'][0]
+                classification_category.append(
+                    classification_category_to_code.setdefault(top1[0], len(classification_category_to_code)))
+                classification_conf.append(top1[1])
+            else:
+                classification_category.append(-1)
+                classification_conf.append(np.nan)
+    
+    arrays = DetectionArrays()
+    n_detections_per_image = np.array(n_detections_per_image, dtype=np.int64)
+    arrays.image_start = np.zeros(len(n_detections_per_image) + 1, dtype=np.int64)
+    np.cumsum(n_detections_per_image, out=arrays.image_start[1:])
+    arrays.image_index = np.repeat(np.arange(len(n_detections_per_image), dtype=np.int32),
+                                   n_detections_per_image)
+    arrays.conf = np.array(conf, dtype=np.float32)
+    arrays.bbox = np.array(bbox, dtype=np.float32).reshape(-1, 4)
+    arrays.category = np.array(category, dtype=np.int16)
+    arrays.category_ids = list(category_to_code.keys())
+    arrays.classification_category = np.array(classification_category, dtype=np.int16)
+    arrays.classification_conf = np.array(classification_conf, dtype=np.float32)
+    arrays.classification_category_ids = list(classification_category_to_code.keys())
+    
+    return arrays
+
+
 def write_api_results(detection_results_table, other_fields, out_path):
     """
     Writes a Pandas DataFrame back to a json that is compatible with the API output format.
@@ -132,16 +369,10 @@ def load_api_results_csv(filename, normalize_paths=True, filename_replacements={
 
         replacement_string = filename_replacements[string_to_replace]
 
-        # TODO: hit some silly issues with vectorized str() and escaped characters, vectorize
-        # this later.
-        #
-        # detection_results['image_path'].str.replace(string_to_replace,replacement_string)
-        # iRow = 0
-        for iRow in range(0,len(detection_results)):
-            row = detection_results.iloc[iRow]
-            fn = row['image_path']
-            fn = fn.replace(string_to_replace,replacement_string)
-            detection_results.at[iRow,'image_path'] = fn
+        # Use plain str.replace rather than the vectorized .str.replace, which hit some silly
+        # issues with escaped characters
+        detection_results['image_path'] = [fn.replace(string_to_replace, replacement_string)
+                                           for fn in detection_results['image_path'].to_numpy()]
 
     print('Finished loading and de-serializing API results for {} images from {}'.format(len(detection_results),filename))
 
@@ -32,30 +32,49 @@ import sys
 import collections
 import io
 import warnings
-import copy
 import time
+import gc
+import operator
 from multiprocessing.pool import ThreadPool    
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, lru_cache
 from enum import IntEnum
 import errno
 import uuid
+import hashlib
             
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from sklearn.metrics import precision_recall_curve, confusion_matrix, average_precision_score
+from PIL import Image
+from sklearn.metrics import precision_recall_curve, average_precision_score
 from tqdm import tqdm
 import humanfriendly
 
+# numba is optional; without it, we label and score detections with NumPy
+try:
+    from numba import njit
+    b_numba_available = True
+except ImportError:
+    b_numba_available = False
+
+# OpenCV is optional; without it, we always decode sample images with PIL
+try:
+    import cv2
+    b_opencv_available = True
+except ImportError:
+    b_opencv_available = False
+
 # Assumes ai4eutils is on the python path
 # https://github.com/Microsoft/ai4eutils
 from write_html_image_list import write_html_image_list
 
 # Assumes the cameratraps repo root is on the path
 import visualization.visualization_utils as vis_utils
-from data_management.cct_json_utils import CameraTrapJsonUtils, IndexedJsonDb
-from api.batch_processing.postprocessing.load_api_results import load_api_results
+from data_management.cct_json_utils import IndexedJsonDb
+from api.batch_processing.postprocessing.load_api_results import load_api_results, detections_to_arrays
 from ct_utils import args_to_object
 
 warnings.filterwarnings("ignore", "(Possibly )?corrupt EXIF data", UserWarning)
@@ -66,6 +85,10 @@ warnings.filterwarnings("ignore", "(Possibly )?corrupt EXIF data", UserWarning)
 DEFAULT_NEGATIVE_CLASSES = ['empty']
 DEFAULT_UNKNOWN_CLASSES = ['unknown', 'unlabeled', 'ambiguous']
 
+# Default number of threads to render with when parallelize_rendering_with_threads is set, 
+# parallelize_rendering_n_cores is None, and we're decoding images with PIL
+MAX_DEFAULT_RENDERING_THREADS = 8
+
 
 def has_overlap(set1, set2):
     ''' Helper function that checks whether two sets overlap '''
@@ -107,6 +130,10 @@ class PostProcessingOptions:
     sample_seed = 0 # None
 
     viz_target_width = 800
+    
+    # JPEG quality for rendered sample images (75 is PIL's default); higher values look
+    # better, but make both encoding and the output folder slower/larger
+    viz_jpeg_quality = 75
 
     sort_html_by_filename = True
     
@@ -120,6 +147,11 @@ class PostProcessingOptions:
     api_detection_results = None
     api_other_fields = None
     
+    # Cache the parsed API output in a parquet file next to api_output_file, and load
+    # from that cache on later runs (as long as it's newer than api_output_file); much
+    # faster than re-parsing large .json files, requires pyarrow
+    use_api_output_parquet_cache = False
+    
     # Should we also split out a separate report about the detections that were
     # just below our main confidence threshold?
     #
@@ -128,8 +160,36 @@ class PostProcessingOptions:
     almost_detection_confidence_threshold = 0.75
 
     # Control rendering parallelization
-    parallelize_rendering_n_cores = 100
+    #
+    # Rendering is CPU-bound (decode/resize/draw/encode), so by default we render in
+    # worker processes; None uses one worker per core, and more workers than cores
+    # just oversubscribes the machine.  Set parallelize_rendering_with_threads to use a
+    # thread pool instead, which can be better when images live on a slow network mount
+    # and rendering is I/O-bound; in that case a larger number of workers (e.g. 100)
+    # can make sense.  With threads, None means at most MAX_DEFAULT_RENDERING_THREADS 
+    # workers, unless decode_with_opencv is set.
+    parallelize_rendering_n_cores = None
     parallelize_rendering = False
+    parallelize_rendering_with_threads = False
+    
+    # Decode and resize sample images with OpenCV, if it's installed.  Unlike PIL, OpenCV 
+    # releases the GIL while decoding and resizing, so this makes rendering with threads 
+    # scale with the number of workers.  Previews differ very slightly from PIL's.
+    decode_with_opencv = False
+    
+    # When rendering serially, ask the OS to start reading this many images ahead of the
+    # one we're rendering, so disk (or network) reads overlap with rendering.  Only used 
+    # where os.posix_fadvise is available (i.e., not on Windows), and not when reading 
+    # from the thumbnail cache.  0 disables prefetching.
+    n_images_to_prefetch = 8
+    
+    # Optional folder in which to cache resized source images, keyed on source path,
+    # modification time, and viz_target_width, so repeated runs over the same images
+    # (e.g. while tuning thresholds) don't have to decode full-size images again.  
+    # None disables the cache.  When the cache has more than thumbnail_cache_max_files 
+    # images, the least recently used ones are removed after rendering.
+    thumbnail_cache_dir = None
+    thumbnail_cache_max_files = 10000
     
     
 class PostProcessingResults:
@@ -166,7 +226,130 @@ class DetectionStatus(IntEnum):
     # In some analyses, we add an additional class that lets us look at detections just below
     # our main confidence threshold
     DS_ALMOST = 5
+
+
+# Result type (and html page name) for each predicted DetectionStatus in the 
+# no-ground-truth case
+DETECTION_STATUS_TO_RESULT_TYPE = {
+    DetectionStatus.DS_POSITIVE: 'detections',
+    DetectionStatus.DS_NEGATIVE: 'non_detections',
+    DetectionStatus.DS_ALMOST: 'almost_detections'
+}
+
+
+if b_numba_available:
+    
+    @njit(cache=True)
+    def get_pred_detection_labels_numba(confidences, confidence_threshold, almost_threshold,
+                                        include_almost_detections, positive_label, 
+                                        negative_label, almost_label):
+        """
+        Single-pass version of the NumPy labeling in get_pred_detection_labels
+        """
+        
+        labels = np.empty(confidences.shape[0], dtype=np.int8)
+        for i in range(confidences.shape[0]):
+            conf = confidences[i]
+            if conf >= confidence_threshold:
+                labels[i] = positive_label
+            elif include_almost_detections and conf >= almost_threshold:
+                labels[i] = almost_label
+            else:
+                labels[i] = negative_label
+        return labels
+    
+    @njit(cache=True)
+    def get_detection_confusion_counts_numba(gt_detections, p_detection, confidence_threshold):
+        """
+        Single-pass version of the NumPy counting in get_detection_confusion_counts
+        """
         
+        tn = fp = fn = tp = 0
+        for i in range(gt_detections.shape[0]):
+            detected = p_detection[i] > confidence_threshold
+            if gt_detections[i] > 0.5:
+                if detected:
+                    tp += 1
+                else:
+                    fn += 1
+            else:
+                if detected:
+                    fp += 1
+                else:
+                    tn += 1
+        return tn, fp, fn, tp
+        
+
+def get_pred_detection_labels(confidences, options):
+    """
+    Returns an array of predicted DetectionStatus values (as int8), one per element of
+    confidences (max detection confidence per image): DS_POSITIVE at or above 
+    options.confidence_threshold, DS_ALMOST at or above 
+    options.almost_detection_confidence_threshold if options.include_almost_detections
+    is set, otherwise DS_NEGATIVE.
+    """
+    
+    confidences = np.asarray(confidences, dtype=np.float64)
+    
+    if b_numba_available:
+        return get_pred_detection_labels_numba(
+            confidences, options.confidence_threshold, options.almost_detection_confidence_threshold,
+            options.include_almost_detections, int(DetectionStatus.DS_POSITIVE),
+            int(DetectionStatus.DS_NEGATIVE), int(DetectionStatus.DS_ALMOST))
+    
+    conditions = [confidences >= options.confidence_threshold]
+    choices = [DetectionStatus.DS_POSITIVE]
+    if options.include_almost_detections:
+        conditions.append(confidences >= options.almost_detection_confidence_threshold)
+        choices.append(DetectionStatus.DS_ALMOST)
+    return np.select(conditions, choices, default=DetectionStatus.DS_NEGATIVE).astype(np.int8)
+
+
+def get_detection_confusion_counts(gt_detections, p_detection, confidence_threshold):
+    """
+    Given ground truth (0.0/1.0) and max detection confidence for each image, returns 
+    (tn, fp, fn, tp), treating images with confidence above confidence_threshold as
+    detections.
+    
+    Counts are returned as numpy ints, like sklearn's confusion_matrix, so ratios of them
+    (e.g. precision with no detections) are nan rather than raising ZeroDivisionError.
+    """
+    
+    if b_numba_available:
+        counts = get_detection_confusion_counts_numba(gt_detections, p_detection, confidence_threshold)
+    else:
+        # Index 2*gt + detected, i.e. [tn, fp, fn, tp]
+        counts = np.bincount(2 * (gt_detections > 0.5).astype(np.int64) + (p_detection > confidence_threshold),
+                             minlength=4)
+    return tuple(np.int64(c) for c in counts)
+        
+
+def get_category_names(category_ids, cat_id_to_name):
+    """
+    Looks up the category name for each element of the array category_ids; returns an
+    object array, with a null value (None or nan) for IDs that aren't in cat_id_to_name.
+    
+    Category IDs are usually small non-negative ints, in which case we index into a
+    name array rather than hashing every ID; otherwise we fall back to a dict lookup.
+    """
+    
+    b_dense_int_ids = len(cat_id_to_name) > 0 and \
+        np.issubdtype(category_ids.dtype, np.integer) and \
+        all(isinstance(k, (int, np.integer)) and k >= 0 for k in cat_id_to_name.keys())
+    if b_dense_int_ids:
+        max_id = max(cat_id_to_name.keys())
+        b_dense_int_ids = max_id < 10 * len(cat_id_to_name) + 1000
+        
+    if not b_dense_int_ids:
+        return pd.Series(category_ids).map(cat_id_to_name).to_numpy()
+    
+    # One extra slot at the end (None) for out-of-range IDs
+    cat_name_array = np.full(max_id + 2, None, dtype=object)
+    for cat_id, name in cat_id_to_name.items():
+        cat_name_array[cat_id] = name
+    category_ids = np.where((category_ids >= 0) & (category_ids <= max_id), category_ids, max_id + 1)
+    return cat_name_array[category_ids]
+
 
 def mark_detection_status(indexed_db, negative_classes=DEFAULT_NEGATIVE_CLASSES,
                           unknown_classes=DEFAULT_UNKNOWN_CLASSES):
@@ -182,84 +365,244 @@ def mark_detection_status(indexed_db, negative_classes=DEFAULT_NEGATIVE_CLASSES,
     negative_classes = set(negative_classes)
     unknown_classes = set(unknown_classes)
 
-    # Counter for the corresponding fields of class (actually enum) DetectionStatus
-    n_unknown = 0
-    n_ambiguous = 0
-    n_positive = 0
-    n_negative = 0
-
     print('Preparing ground-truth annotations')
     db = indexed_db.db
-    for im in tqdm(db['images']):
-
-        image_id = im['id']
-        annotations = indexed_db.image_id_to_annotations[image_id]
-        image_categories = [ann['category_id'] for ann in annotations]
-        image_category_names = set([indexed_db.cat_id_to_name[cat] for cat in image_categories])
-
-        # Check if image has unassigned-type labels
-        image_has_unknown_labels = has_overlap(image_category_names, unknown_classes)
-        # Check if image has negative-type labels
-        image_has_negative_labels = has_overlap(image_category_names, negative_classes)
-        # Check if image has positive labels
-        # i.e. if we remove negative and unknown labels from image_category_names, then
-        # there are still labels left
-        image_has_positive_labels = 0 < len(image_category_names - unknown_classes - negative_classes)
-
-        # If there are no image annotations, the result is unknonw
-        if len(image_categories) == 0:
-
-            n_unknown += 1
-            im['_detection_status'] = DetectionStatus.DS_UNKNOWN
-
-        # If the image has more than one type of labels, it's ambiguous
-        # note: booleans get automatically converted to 0/1, hence we can use the sum
-        elif image_has_unknown_labels + image_has_negative_labels + image_has_positive_labels > 1:
-
-            n_ambiguous += 1
-            im['_detection_status'] = DetectionStatus.DS_AMBIGUOUS
-
-        # After the check above, we can be sure it's only one of positive, negative, or unknown
-        # Important: do not merge the following 'unknown' branch with the first 'unknown' branch
-        # above, where we were testing 'if len(image_categories) == 0'
-        #
-        # If the image has only unknown labels
-        elif image_has_unknown_labels:
+    image_ids = [im['id'] for im in db['images']]
+
+    # Build a table with one row per annotation, and work out each image's status from
+    # per-image reductions over that table, rather than building sets for each image
+    ann_df = pd.DataFrame({'image_id': [ann['image_id'] for ann in db['annotations']],
+                           'category_id': [ann['category_id'] for ann in db['annotations']]})
+    ann_df['name'] = get_category_names(ann_df['category_id'].to_numpy(), indexed_db.cat_id_to_name)
+    assert not ann_df['name'].isna().any(), 'Annotation refers to an unknown category'
+
+    ann_df['is_negative'] = ann_df['name'].isin(negative_classes)
+    ann_df['is_unknown'] = ann_df['name'].isin(unknown_classes)
+    # i.e. if we remove negative and unknown labels from an image's labels, there are
+    # still labels left
+    ann_df['is_positive'] = ~(ann_df['is_negative'] | ann_df['is_unknown'])
+
+    grouped = ann_df.groupby('image_id', sort=False)
+    label_flags = grouped[['is_unknown', 'is_negative', 'is_positive']].any().reindex(
+        image_ids, fill_value=False)
+    image_has_unknown_labels = label_flags['is_unknown'].to_numpy()
+    image_has_negative_labels = label_flags['is_negative'].to_numpy()
+    image_has_positive_labels = label_flags['is_positive'].to_numpy()
+    n_annotations = grouped.size().reindex(image_ids, fill_value=0).to_numpy()
+    n_category_names = grouped['name'].nunique().reindex(image_ids, fill_value=0).to_numpy()
+    first_category_name = grouped['name'].first().reindex(image_ids).to_numpy()
+
+    # Order matters here, the first condition that applies wins:
+    #
+    # * If there are no image annotations, the result is unknown
+    #
+    # * If the image has more than one type of labels, it's ambiguous
+    #
+    # * After that, we can be sure it's only one of positive, negative, or unknown.
+    #   Important: do not merge the second 'unknown' condition with the first one.
+    n_label_types = image_has_unknown_labels.astype(int) + image_has_negative_labels + \
+        image_has_positive_labels
+    status = np.select(
+        [n_annotations == 0, n_label_types > 1, image_has_unknown_labels,
+         image_has_negative_labels, image_has_positive_labels],
+        [DetectionStatus.DS_UNKNOWN, DetectionStatus.DS_AMBIGUOUS, DetectionStatus.DS_UNKNOWN,
+         DetectionStatus.DS_NEGATIVE, DetectionStatus.DS_POSITIVE],
+        default=DetectionStatus.DS_UNASSIGNED)
+    if (status == DetectionStatus.DS_UNASSIGNED).any():
+        raise Exception('Invalid state, please check the code for bugs')
+
+    # Annotate the category of positive images, if it is unambiguous
+    b_unambiguous = (status == DetectionStatus.DS_POSITIVE) & (n_category_names == 1)
+
+    status_values = {ds.value: ds for ds in DetectionStatus}
+    for i_image, im in enumerate(db['images']):
+        im['_detection_status'] = status_values[status[i_image]]
+        if b_unambiguous[i_image]:
+            im['_unambiguous_category'] = first_category_name[i_image]
+
+    n_negative = int(np.count_nonzero(status == DetectionStatus.DS_NEGATIVE))
+    n_positive = int(np.count_nonzero(status == DetectionStatus.DS_POSITIVE))
+    n_unknown = int(np.count_nonzero(status == DetectionStatus.DS_UNKNOWN))
+    n_ambiguous = int(np.count_nonzero(status == DetectionStatus.DS_AMBIGUOUS))
 
-            n_unknown += 1
-            im['_detection_status'] = DetectionStatus.DS_UNKNOWN
+    return n_negative, n_positive, n_unknown, n_ambiguous
 
-        # If the image has only negative labels
-        elif image_has_negative_labels:
 
-            n_negative += 1
-            im['_detection_status'] = DetectionStatus.DS_NEGATIVE
+@lru_cache(maxsize=None)
+def get_max_filename_length(dir_name):
+    """
+    Returns the maximum length (in bytes) of a file name in the file system containing
+    dir_name, or 255 (the most common limit) if we can't find out.
+    """
+    
+    try:
+        return os.pathconf(dir_name, 'PC_NAME_MAX')
+    except (AttributeError, ValueError, OSError):
+        return 255
+    
 
-        # If the images has only positive labels
-        elif image_has_positive_labels:
+def load_resized_image_opencv(image_full_path, target_width):
+    """
+    OpenCV equivalent of decoding with vis_utils.open_image (with a draft size) and resizing
+    with vis_utils.resize_image; returns a PIL image.
+    """
+    
+    # PIL doesn't apply EXIF rotation, and detector coordinates are relative to the 
+    # un-rotated image, so don't let OpenCV apply it either
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if target_width > 0:
+        # As with PIL's draft(), for JPEGs, decode at the largest power-of-two reduction
+        # that keeps the width >= the target width; reading the header is cheap
+        with Image.open(image_full_path) as header:
+            width = header.size[0]
+            is_jpeg = header.format == 'JPEG'
+        if is_jpeg:
+            for scale, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), 
+                                        (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                        (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if width / scale >= target_width:
+                    flags = reduced_flag | cv2.IMREAD_IGNORE_ORIENTATION
+                    break
+                
+    image = cv2.imread(image_full_path, flags)
+    if image is None:
+        raise IOError('Could not read image {}'.format(image_full_path))
+        
+    if target_width > 0:
+        aspect_ratio = image.shape[1] / image.shape[0]
+        target_height = int(target_width / aspect_ratio)
+        # INTER_AREA is OpenCV's closest match to PIL's antialiased downsampling, but it 
+        # degenerates to nearest-neighbor when enlarging
+        interpolation = cv2.INTER_AREA if target_width < image.shape[1] else cv2.INTER_LANCZOS4
+        image = cv2.resize(image, (target_width, target_height), interpolation=interpolation)
+        
+    return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    
+    
+def load_resized_image(image_full_path, options):
+    """
+    Loads an image and resizes it to options.viz_target_width, going through the 
+    thumbnail cache in options.thumbnail_cache_dir if one is set.  Raises if the 
+    source image can't be opened.
+    """
+    
+    b_use_opencv = options.decode_with_opencv and b_opencv_available
+    
+    cache_path = None
+    if options.thumbnail_cache_dir is not None:
+        # OpenCV and PIL (with a draft size) produce slightly different thumbnails, so 
+        # the decoder is part of the key
+        decoder = 'opencv' if b_use_opencv else 'pil_draft'
+        cache_key = '{}|{}|{}|{}'.format(os.path.abspath(image_full_path),
+                                         os.path.getmtime(image_full_path), options.viz_target_width,
+                                         decoder)
+        cache_path = os.path.join(options.thumbnail_cache_dir,
+                                  hashlib.sha1(cache_key.encode('utf-8')).hexdigest() + '.jpg')
+        try:
+            image = vis_utils.open_image(cache_path)
+            image.load()
+            # Update the modification time, which we use to evict least recently used entries
+            os.utime(cache_path)
+            return image
+        except OSError:
+            pass
+        
+    # We're only rendering a preview at viz_target_width, so for JPEGs, let the decoder
+    # downscale by a power of two while it decodes (keeping the width >= the target 
+    # width), rather than decoding at full resolution and throwing most pixels away.
+    if b_use_opencv:
+        image = load_resized_image_opencv(image_full_path, options.viz_target_width)
+    else:
+        draft_size = None
+        if options.viz_target_width > 0:
+            draft_size = (options.viz_target_width, 1)
+            
+        image = vis_utils.open_image(image_full_path, draft_size=draft_size)
+        image = vis_utils.resize_image(image, options.viz_target_width)
+    
+    if cache_path is not None:
+        # Write to a temporary file first, so parallel workers never see a partial image
+        os.makedirs(options.thumbnail_cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        image.save(tmp_path, format='JPEG', quality=95)
+        os.replace(tmp_path, cache_path)
+        
+    return image
 
-            n_positive += 1
-            im['_detection_status'] = DetectionStatus.DS_POSITIVE
 
-            # Annotate the category, if it is unambiguous
-            if len(image_category_names) == 1:
-                im['_unambiguous_category'] = list(image_category_names)[0]
+def purge_thumbnail_cache(cache_dir, max_files):
+    """
+    Removes the least recently used images from the thumbnail cache in cache_dir, until
+    at most max_files remain.
+    """
+    
+    if not os.path.isdir(cache_dir):
+        return
+    
+    cache_files = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.jpg')]
+    if len(cache_files) <= max_files:
+        return
+    
+    cache_files.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in cache_files[:len(cache_files) - max_files]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
 
-        else:
-            raise Exception('Invalid state, please check the code for bugs')
 
-    return n_negative, n_positive, n_unknown, n_ambiguous
+def prefetch_file(file_path):
+    """
+    Asks the OS to start reading file_path into the page cache, without waiting for the
+    read.  Does nothing if the file can't be opened.
+    """
+    
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        # We'll report missing images when we try to render them
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+        
 
+def prefetch_images(files_to_render, image_base_dir, n_images_to_prefetch):
+    """
+    Yields the elements of files_to_render unchanged, prefetching each image (the first 
+    element of each element of files_to_render, relative to image_base_dir) 
+    n_images_to_prefetch elements before it's yielded.
+    """
+    
+    pending = collections.deque()
+    for file_info in files_to_render:
+        prefetch_file(os.path.join(image_base_dir, file_info[0]))
+        pending.append(file_info)
+        if len(pending) > n_images_to_prefetch:
+            yield pending.popleft()
+    yield from pending
+    
 
 def render_bounding_boxes(image_base_dir, image_relative_path, display_name, detections, res,
-                          detection_categories_map=None, classification_categories_map=None, options=None):
+                          detection_categories_map=None, classification_categories_map=None, options=None,
+                          confidence_threshold=None):
         """
         Renders detection bounding boxes on a single image.  Returns the html info struct
         for this image in the form that's used for write_html_image_list.
+        
+        Boxes are drawn for detections above confidence_threshold, which defaults to
+        options.confidence_threshold.
+        
+        display_name can also be a function that returns the display name, in which case 
+        it's only called if the image is successfully rendered.
         """
         
         if options is None:
             options = PostProcessingOptions()
+            
+        if confidence_threshold is None:
+            confidence_threshold = options.confidence_threshold
 
         # Leaving code in place for reading from blob storage, may support this
         # in the future.
@@ -279,34 +622,49 @@ def render_bounding_boxes(image_base_dir, image_relative_path, display_name, det
                 return ''
         
         try:
-            image = vis_utils.open_image(image_full_path)
+            image = load_resized_image(image_full_path, options)
         except:
             print('Warning: could not open image file {}'.format(image_full_path))
             return ''
-        
-        image = vis_utils.resize_image(image, options.viz_target_width)
 
-        vis_utils.render_detection_bounding_boxes(detections, image,
-                                                  label_map=detection_categories_map,
-                                                  classification_label_map=classification_categories_map,
-                                                  confidence_threshold=options.confidence_threshold,
-                                                  thickness=4)
+        # Many sampled images (e.g. tn/fn/non_detections) have no boxes above threshold; for
+        # those, the preview is just the resized image, so don't bother with the drawing code
+        if any(det['conf'] > confidence_threshold for det in detections):
+            vis_utils.render_detection_bounding_boxes(detections, image,
+                                                      label_map=detection_categories_map,
+                                                      classification_label_map=classification_categories_map,
+                                                      confidence_threshold=confidence_threshold,
+                                                      thickness=4)
 
         # Render images to a flat folder... we can use os.sep here because we've
         # already normalized paths
         sample_name = res + '_' + image_relative_path.replace(os.sep, '~')
 
+        # If we already know the name is too long for the file system, go straight to a 
+        # random name, rather than waiting for the save to fail
+        if len(sample_name.encode('utf-8')) > get_max_filename_length(options.output_dir):
+            sample_name = res + '_' + str(uuid.uuid4()) + '.jpg'
+            
+        save_options = {}
+        if os.path.splitext(sample_name)[1].lower() in ('.jpg', '.jpeg'):
+            save_options = {'quality': options.viz_jpeg_quality, 'subsampling': 2, 
+                            'optimize': False, 'progressive': False}
+            
         try:
-            image.save(os.path.join(options.output_dir, res, sample_name))
+            image.save(os.path.join(options.output_dir, res, sample_name), **save_options)
         except OSError as e:
             if e.errno == errno.ENAMETOOLONG:
                 sample_name = res + '_' + str(uuid.uuid4()) + '.jpg'
-                image.save(os.path.join(options.output_dir, res, sample_name))
+                image.save(os.path.join(options.output_dir, res, sample_name),
+                           quality=options.viz_jpeg_quality)
             else:
                 raise
 
         # Use slashes regardless of os
         file_name = '{}/{}'.format(res, sample_name)
+        
+        if callable(display_name):
+            display_name = display_name()
 
         return {
             'filename': file_name,
@@ -315,12 +673,226 @@ def render_bounding_boxes(image_base_dir, image_relative_path, display_name, det
         }
 
 
+def get_sample_result_types(gt_presence, max_conf, classification_accuracy, options):
+    """
+    Assigns a result type (tp, tpc, tpi, fp, fn, or tn) to each sampled image, given arrays
+    of ground truth presence, max detection confidence, and classification accuracy (NaN 
+    for images without classification evaluation).
+    """
+    
+    detected = max_conf > options.confidence_threshold
+    tp = gt_presence & detected
+    b_evaluated = ~np.isnan(classification_accuracy)
+    
+    # Accuracies are ratios like 1/k, so a plain tolerance check is all we need here, 
+    # rather than np.isclose's relative tolerance and inf handling; NaNs compare False
+    b_all_correct = np.abs(classification_accuracy - 1.0) < 1e-8
+    
+    return np.select([tp & ~b_evaluated,
+                      tp & b_all_correct,
+                      tp,
+                      ~gt_presence & detected,
+                      gt_presence & ~detected],
+                     ['tp', 'tpc', 'tpi', 'fp', 'fn'], default='tn').astype(object)
+    
+
+def render_image_with_gt(file_info, detection_categories_map=None, 
+                         classification_categories_map=None, options=None,
+                         class_name_to_html_key=None):
+    """
+    Renders a single image for the ground-truth case; file_info is a list of
+    [file, max_conf, detections, image_id, image, gt_classes, res], where image is the 
+    ground truth image record, gt_classes the list of annotated class names for that 
+    image, and res the result type (tp, tpc, tpi, fp, fn, or tn) from get_sample_result_types.
+    
+    class_name_to_html_key optionally maps ground truth class names to their collection 
+    names (e.g. 'deer' --> 'class_deer'), so we don't re-format them for every image.
+
+    Returns a list of [collection name, html info struct] pairs, or None if the image
+    was skipped.
+    """
+    
+    image_relative_path = file_info[0]
+    max_conf = file_info[1]
+    detections = file_info[2]
+    image_id = file_info[3]
+    image = file_info[4]
+    gt_classes = file_info[5]
+    res = file_info[6]
+
+    # This should already have been normalized to either '/' or '\'
+
+    if image_id is None:
+        print('Warning: couldn''t find ground truth for image {}'.format(image_relative_path))
+        return None
+
+    gt_status = image['_detection_status']
+
+    gt_presence = bool(gt_status)
+
+    gt_class_summary = ','.join(gt_classes)
+
+    if gt_status > DetectionStatus.DS_MAX_DEFINITIVE_VALUE:
+        print('Skipping image {}, does not have a definitive ground truth status (status: {}, classes: {})'.format(
+                image_id, gt_status, gt_class_summary))
+        return None
+
+    # Only format the display name if we actually render this image
+    display_name = partial('<b>Result type</b>: {}, <b>Presence</b>: {}, <b>Class</b>: {}, <b>Max conf</b>: {:0.2f}%, <b>Image</b>: {}'.format,
+        res.upper(), str(gt_presence), gt_class_summary,
+        max_conf * 100, image_relative_path)
+
+    rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
+                                                        image_relative_path,
+                                                        display_name,
+                                                        detections,
+                                                        res,
+                                                        detection_categories_map,
+                                                        classification_categories_map,
+                                                        options)
+
+    image_result = None
+    if len(rendered_image_html_info) > 0:
+        image_result = [[res,rendered_image_html_info]]
+        for gt_class in gt_classes:
+            if class_name_to_html_key is not None and gt_class in class_name_to_html_key:
+                class_key = class_name_to_html_key[gt_class]
+            else:
+                class_key = 'class_{}'.format(gt_class)
+            image_result.append([class_key,rendered_image_html_info])
+    
+    return image_result
+    
+
+def render_image_no_gt(file_info, detection_categories_map=None, 
+                       classification_categories_map=None, options=None,
+                       classification_category_to_html_key=None):
+    """
+    Renders a single image for the no-ground-truth case; file_info is a list of
+    [file, max_conf, detections, detection_status], where detection_status is the 
+    predicted DetectionStatus from get_pred_detection_labels.
+    
+    classification_category_to_html_key optionally maps classification category IDs 
+    straight to their collection names (e.g. '3' --> 'class_deer'), so we don't look up
+    and re-format class names for every detection.
+
+    Returns a list of [collection name, html info struct] pairs, or None if the image
+    could not be rendered.
+    """
+    
+    image_relative_path = file_info[0]
+    max_conf = file_info[1]
+    detections = file_info[2]
+    detection_status = file_info[3]
+    
+    res = DETECTION_STATUS_TO_RESULT_TYPE[detection_status]
+
+    # Only format the display name if we actually render this image
+    display_name = partial('<b>Result type</b>: {}, <b>Image</b>: {}, <b>Max conf</b>: {}'.format,
+        res, image_relative_path, max_conf)
+
+    rendering_threshold = options.confidence_threshold
+    if detection_status == DetectionStatus.DS_ALMOST:
+        rendering_threshold = options.almost_detection_confidence_threshold
+    rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
+                                                        image_relative_path,
+                                                        display_name,
+                                                        detections,
+                                                        res,
+                                                        detection_categories_map,
+                                                        classification_categories_map,
+                                                        options,
+                                                        rendering_threshold)
+    
+    image_result = None
+    if len(rendered_image_html_info) > 0:
+        image_result = [[res,rendered_image_html_info]]
+        for det in detections:
+            if 'classifications' in det:
+                top1_category = det['classifications'][0][0]
+                if classification_category_to_html_key is not None:
+                    class_key = classification_category_to_html_key[top1_category]
+                else:
+                    class_key = 'class_{}'.format(classification_categories_map[top1_category])
+                image_result.append([class_key,rendered_image_html_info])
+    
+    return image_result
+
+
+# The render function (with options and category maps bound) used by each rendering 
+# worker process; set once per worker by init_render_worker, so we don't have to send 
+# it along with every batch of images
+_worker_render_function = None
+
+
+def init_render_worker(render_function):
+    
+    global _worker_render_function
+    _worker_render_function = render_function
+    
+
+def render_in_worker(file_info):
+    
+    return _worker_render_function(file_info)
+
+
+def render_images(render_function, files_to_render, n_files, options):
+    """
+    Applies render_function (render_image_with_gt or render_image_no_gt, with the
+    category maps and options already bound) to each element of files_to_render, 
+    optionally in parallel.  files_to_render can be any iterable (of length n_files, 
+    used for progress reporting); results are yielded as they become available, in 
+    the same order as files_to_render.
+    """
+    
+    if options.parallelize_rendering:
+        
+        n_workers = options.parallelize_rendering_n_cores
+        if n_workers is not None:
+            print('Rendering images with {} workers'.format(n_workers))
+        elif options.parallelize_rendering_with_threads and not \
+                (options.decode_with_opencv and b_opencv_available):
+            # PIL holds the GIL for most of the decode/resize work, so beyond a handful of
+            # threads, more threads just add contention
+            n_workers = min(MAX_DEFAULT_RENDERING_THREADS, os.cpu_count())
+        
+        # Hand out work in batches of images, about four per worker, rather than one
+        # image at a time
+        chunksize = max(1, n_files // ((n_workers or os.cpu_count()) * 4))
+        
+        if options.parallelize_rendering_with_threads:
+            pool = ThreadPool(n_workers)
+            yield from tqdm(pool.imap(render_function, files_to_render, chunksize=chunksize), 
+                            total=n_files)
+            pool.close()
+        else:
+            # Send the render function (and with it the options and category maps) to each
+            # worker once, rather than with every batch of images
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=init_render_worker,
+                                     initargs=(render_function,)) as executor:
+                yield from tqdm(executor.map(render_in_worker, files_to_render, chunksize=chunksize),
+                                total=n_files)
+    else:
+        # Worker pools already overlap reading one image with rendering others, but
+        # when rendering serially, we have to ask for that explicitly
+        if options.n_images_to_prefetch > 0 and hasattr(os, 'posix_fadvise') and \
+                options.thumbnail_cache_dir is None:
+            files_to_render = prefetch_images(files_to_render, options.image_base_dir, 
+                                              options.n_images_to_prefetch)
+        for file_info in tqdm(files_to_render, total=n_files):
+            yield render_function(file_info)
+            
+    if options.thumbnail_cache_dir is not None:
+        purge_thumbnail_cache(options.thumbnail_cache_dir, options.thumbnail_cache_max_files)
+            
+
 def prepare_html_subpages(images_html, output_dir, options=None):
     """
     Write out a series of html image lists, e.g. the fp/tp/fn/tn pages.
 
     image_html is a dictionary mapping an html page name (e.g. "fp") to a list
-    of image structs friendly to write_html_image_list
+    of image structs friendly to write_html_image_list; if options.sort_html_by_filename
+    is set, these lists are sorted in place.
     """
     if options is None:
             options = PostProcessingOptions()
@@ -330,26 +902,100 @@ def prepare_html_subpages(images_html, output_dir, options=None):
     for res, array in images_html.items():
         image_counts[res] = len(array)
 
-    # Optionally sort by filename before writing to html
+    # Optionally sort by filename (in place) before writing to html
     if options.sort_html_by_filename:
-        images_html_sorted = {}
-        for res, array in images_html.items():
-            sorted_array = sorted(array, key=lambda x: x['filename'])
-            images_html_sorted[res] = sorted_array
-        images_html = images_html_sorted
+        filename_key = operator.itemgetter('filename')
+        for array in images_html.values():
+            array.sort(key=filename_key)
 
-    # Write the individual HTML files
-    for res, array in images_html.items():
+    # Write the individual HTML files; this is I/O-bound, so use a few threads
+    def write_html_subpage(res_and_array):
+        res, array = res_and_array
         write_html_image_list(
             filename=os.path.join(output_dir, '{}.html'.format(res)),
             images=array,
             options={
                 'headerHtml': '<h1>{}</h1>'.format(res.upper())
             })
+        
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write_html_subpage, images_html.items()))
 
     return image_counts
 
 
+#%% Index page templates
+
+HTML_STYLE_HEADER = """<head>
+        <style type="text/css">
+        <!--
+        a { text-decoration:none; }
+        body { font-family:segoe ui, calibri, "trebuchet ms", verdana, arial, sans-serif; }
+        div.contentdiv { margin-left:20px; }
+        -->
+        </style>
+        </head>"""
+
+# Page header and sample image summary for the ground truth case
+GT_INDEX_PAGE_HEADER_TEMPLATE = """<html>
+        {style_header}
+        <body>
+        <h2>Evaluation</h2>
+
+        <h3>Sample images</h3>
+        <div style="margin-left:20px;">
+        <p>A sample of {image_count} images, annotated with detections above {confidence_threshold:.1%} confidence.</p>
+        <a href="tp.html">True positives (TP)</a> ({tp_count}) ({tp_fraction:0.1%})<br/>
+        {classification_summary}
+        <a href="tn.html">True negatives (TN)</a> ({tn_count}) ({tn_fraction:0.1%})<br/>
+        <a href="fp.html">False positives (FP)</a> ({fp_count}) ({fp_fraction:0.1%})<br/>
+        <a href="fn.html">False negatives (FN)</a> ({fn_count}) ({fn_fraction:0.1%})<br/>
+        {classification_footnote}
+        </div>        
+        """
+
+# Extra sample-image lines for the ground truth case when we've evaluated classifications
+GT_INDEX_PAGE_CLASSIFICATION_SUMMARY_TEMPLATE = """&nbsp;&nbsp;&nbsp;&nbsp;<a href="tpc.html">with all correct top-1 predictions (TPC)</a> ({tpc_count})<br/>
+           &nbsp;&nbsp;&nbsp;&nbsp;<a href="tpi.html">with one or more incorrect top-1 prediction (TPI)</a> ({tpi_count})<br/>
+           &nbsp;&nbsp;&nbsp;&nbsp;<a href="tp.html">without classification evaluation</a><sup>*</sup> ({tp_count})<br/>"""
+
+GT_INDEX_PAGE_CLASSIFICATION_FOOTNOTE = """<p><sup>*</sup>We do not evaluate the classification result of images 
+                if the classification information is missing, if the image contains
+                categories like &lsquo;empty&rsquo; or &lsquo;human&rsquo;, or if the image has multiple 
+                classification labels.</p>"""
+
+GT_INDEX_PAGE_DETECTION_RESULTS_TEMPLATE = """
+            <h3>Detection results</h3>
+            <div class="contentdiv">
+            <p>At a confidence threshold of {confidence_threshold:0.1%}, precision={precision:0.1%}, recall={recall:0.1%}</p>
+            <p><strong>Precision/recall summary for all {n_images} images</strong></p><img src="{pr_figure}"><br/>
+            </div>
+            """
+
+GT_INDEX_PAGE_CLASSIFICATION_RESULTS_TEMPLATE = """
+                <h3>Classification results</h3>
+                <div class="contentdiv">
+                <p>Classification accuracy: {accuracy:.2%}<br>
+                The accuracy is computed only for images with exactly one classification label.
+                The accuracy of an image is computed as 1/(number of unique detected top-1 classes),
+                i.e. if the model detects multiple boxes with different top-1 classes, then the accuracy
+                decreases and the image is put into 'TPI'.</p>
+                <p>Confusion matrix:</p>
+                <p><img src="{cm_figure}"></p>
+                <div style='font-family:monospace;display:block;'>{cm_text}</div>
+                </div>
+                """
+
+# Page header and sample image summary for the no-ground-truth case
+NO_GT_INDEX_PAGE_HEADER_TEMPLATE = """<html>{style_header}<body>
+        <h2>Visualization of results</h2>
+        <p>A sample of {image_count} images, annotated with detections above {confidence_threshold:.1%} confidence{almost_detection_string}.</p>
+        <h3>Sample images</h3>
+        <div class="contentdiv">
+        <a href="detections.html">detections</a> ({detections_count}, {detections_fraction:.1%})<br/>
+        <a href="non_detections.html">non-detections</a> ({non_detections_count}, {non_detections_fraction:.1%})<br/>"""
+
+
 #%% Main function
 
 def process_batch_results(options):
@@ -387,7 +1033,8 @@ def process_batch_results(options):
     if options.api_detection_results is None:
         detection_results, other_fields = load_api_results(options.api_output_file,
                                                  normalize_paths=True,
-                                                 filename_replacements=options.api_output_filename_replacements)
+                                                 filename_replacements=options.api_output_filename_replacements,
+                                                 use_parquet_cache=options.use_api_output_parquet_cache)
         ppresults.api_detection_results = detection_results
         ppresults.api_other_fields = other_fields
         
@@ -404,22 +1051,16 @@ def process_batch_results(options):
         classification_categories_map = {}
 
     # Add a column (pred_detection_label) to indicate predicted detection status, not separating out the classes    
-    if options.include_almost_detections:
-        detection_results['pred_detection_label'] = DetectionStatus.DS_ALMOST
-        confidences = detection_results['max_detection_conf']
-        detection_results.loc[confidences >= options.confidence_threshold,'pred_detection_label'] = DetectionStatus.DS_POSITIVE
-        detection_results.loc[confidences < options.almost_detection_confidence_threshold,'pred_detection_label'] = DetectionStatus.DS_NEGATIVE        
-    else:
-        detection_results['pred_detection_label'] = \
-        np.where(detection_results['max_detection_conf'] >= options.confidence_threshold,
-                 DetectionStatus.DS_POSITIVE, DetectionStatus.DS_NEGATIVE)
+    detection_results['pred_detection_label'] = get_pred_detection_labels(
+        detection_results['max_detection_conf'].to_numpy(), options)
         
-    n_positives = sum(detection_results['pred_detection_label'] == DetectionStatus.DS_POSITIVE)
+    pred_detection_labels = detection_results['pred_detection_label'].to_numpy()
+    n_positives = int((pred_detection_labels == DetectionStatus.DS_POSITIVE).sum())
     print('Finished loading and preprocessing {} rows from detector output, predicted {} positives'.format(
             len(detection_results), n_positives))
 
     if options.include_almost_detections:
-        n_almosts = sum(detection_results['pred_detection_label'] == DetectionStatus.DS_ALMOST)
+        n_almosts = int((pred_detection_labels == DetectionStatus.DS_ALMOST).sum())
         print('...and {} almost-positives'.format(n_almosts))
     
 
@@ -427,21 +1068,14 @@ def process_batch_results(options):
 
     if ground_truth_indexed_db is not None:
 
-        b_match = [False] * len(detection_results)
-
-        detector_files = detection_results['file'].tolist()
+        gt_filenames = pd.Index(ground_truth_indexed_db.filename_to_id.keys())
+        b_match = detection_results['file'].isin(gt_filenames).to_numpy()
 
-        # fn = detector_files[0]; print(fn)
-        for i_fn, fn in enumerate(detector_files):
+        print('Confirmed filename matches to ground truth for {} of {} files'.format(
+            np.count_nonzero(b_match), len(detection_results)))
 
-            # assert fn in ground_truth_indexed_db.filename_to_id, 'Could not find ground truth for row {} ({})'.format(i_fn,fn)
-            if fn in ground_truth_indexed_db.filename_to_id:
-                b_match[i_fn] = True
-
-        print('Confirmed filename matches to ground truth for {} of {} files'.format(sum(b_match), len(detector_files)))
-
-        detection_results = detection_results[b_match]
-        detector_files = detection_results['file'].tolist()
+        detection_results = detection_results.loc[b_match]
+        detector_files = detection_results['file'].to_numpy()
 
         assert len(detector_files) > 0, 'No detection files available, possible ground truth path issue?'
         
@@ -459,15 +1093,7 @@ def process_batch_results(options):
 
     output_html_file = ''
 
-    style_header = """<head>
-        <style type="text/css">
-        <!--
-        a { text-decoration:none; }
-        body { font-family:segoe ui, calibri, "trebuchet ms", verdana, arial, sans-serif; }
-        div.contentdiv { margin-left:20px; }
-        -->
-        </style>
-        </head>"""
+    style_header = HTML_STYLE_HEADER
 
         
     ##%% Fork here depending on whether or not ground truth is available
@@ -484,20 +1110,14 @@ def process_batch_results(options):
         p_detection = detection_results['max_detection_conf'].values
         n_detections = len(p_detection)
 
-        # numpy array of bools (0.0/1.0), and -1 as null value
-        gt_detections = np.zeros(n_detections, dtype=float)
-
-        for i_detection, fn in enumerate(detector_files):
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detection_status = image['_detection_status']
-
-            if detection_status == DetectionStatus.DS_NEGATIVE:
-                gt_detections[i_detection] = 0.0
-            elif detection_status == DetectionStatus.DS_POSITIVE:
-                gt_detections[i_detection] = 1.0
-            else:
-                gt_detections[i_detection] = -1.0
+        # numpy array of bools (0.0/1.0), and -1 as null value; float32 is plenty for 
+        # these, and halves the size of the precision/recall arrays
+        status_to_float = {DetectionStatus.DS_NEGATIVE: 0.0, DetectionStatus.DS_POSITIVE: 1.0}
+        filename_to_gt_value = {
+            fn: status_to_float.get(ground_truth_indexed_db.image_id_to_image[image_id]['_detection_status'], -1.0)
+            for fn, image_id in ground_truth_indexed_db.filename_to_id.items()}
+        gt_detections = detection_results['file'].map(filename_to_gt_value).fillna(-1.0).to_numpy(
+            dtype=np.float32)
 
         # Don't include ambiguous/unknown ground truth in precision/recall analysis
         b_valid_ground_truth = gt_detections >= 0.0
@@ -505,7 +1125,7 @@ def process_batch_results(options):
         p_detection_pr = p_detection[b_valid_ground_truth]
         gt_detections_pr = gt_detections[b_valid_ground_truth]
 
-        print('Including {} of {} values in p/r analysis'.format(np.sum(b_valid_ground_truth),
+        print('Including {} of {} values in p/r analysis'.format(int(b_valid_ground_truth.sum()),
               len(b_valid_ground_truth)))
 
         precisions, recalls, thresholds = precision_recall_curve(gt_detections_pr, p_detection_pr)
@@ -523,21 +1143,20 @@ def process_batch_results(options):
         average_precision = average_precision_score(gt_detections_pr, p_detection_pr)
         print('Average precision: {:.1%}'.format(average_precision))
 
-        # Thresholds go up throughout precisions/recalls/thresholds; find the last
-        # value where recall is at or above target.  That's our precision @ target recall.
-        target_recall = 0.9
-        b_above_target_recall = np.where(recalls >= target_recall)
-        if not np.any(b_above_target_recall):
+        # Thresholds go up throughout precisions/recalls/thresholds, so recall never goes
+        # up; find the last value where recall is at or above target.  That's our 
+        # precision @ target recall.
+        target_recall = options.target_recall
+        assert np.all(np.diff(recalls) <= 0), 'Recall values are not in decreasing order'
+        i_above_target_recall = np.flatnonzero(recalls >= target_recall)
+        if i_above_target_recall.size == 0:
             precision_at_target_recall = 0.0
         else:
-            i_target_recall = np.argmax(b_above_target_recall)
-            precision_at_target_recall = precisions[i_target_recall]
+            precision_at_target_recall = precisions[i_above_target_recall[-1]]
         print('Precision at {:.1%} recall: {:.1%}'.format(target_recall, precision_at_target_recall))
 
-        cm = confusion_matrix(gt_detections_pr, np.array(p_detection_pr) > options.confidence_threshold)
-
-        # Flatten the confusion matrix
-        tn, fp, fn, tp = cm.ravel()
+        tn, fp, fn, tp = get_detection_confusion_counts(gt_detections_pr, p_detection_pr, 
+                                                        options.confidence_threshold)
 
         precision_at_confidence_threshold = tp / (tp + fp)
         recall_at_confidence_threshold = tp / (tp + fn)
@@ -549,75 +1168,79 @@ def process_batch_results(options):
 
         ##%% Collect classification results, if they exist
         
-        classifier_accuracies = []
+        # Flatten the per-detection fields we need into arrays, so we can evaluate all
+        # images at once instead of probing each detection dict
+        detection_arrays = detections_to_arrays(detection_results['detections'].to_numpy())
         
-        # Mapping of classnames to idx for the confusion matrix.
-        #
-        # The lambda is actually kind of a hack, because we use assume that
-        # the following code does not reassign classname_to_idx
-        classname_to_idx = collections.defaultdict(lambda: len(classname_to_idx))
+        # Assign integer codes to all the class names we might see, either as an
+        # unambiguous ground truth category or as a top-1 predicted category
+        classname_to_code = {}
+        
+        # Ground truth class code for each image, or -1 if the image isn't a positive 
+        # image with an unambiguous class annotated
+        assert len(detector_files) == len(detection_results)
+        gt_images = [ground_truth_indexed_db.image_id_to_image[ground_truth_indexed_db.filename_to_id[fn]]
+                     for fn in detector_files]
+        gt_codes = np.array(
+            [classname_to_code.setdefault(image['_unambiguous_category'], len(classname_to_code))
+             if ('_unambiguous_category' in image.keys() 
+                 and image['_detection_status'] == DetectionStatus.DS_POSITIVE) else -1
+             for image in gt_images], dtype=np.int64)
         
-        # Confusion matrix as defaultdict of defaultdict
+        # Predicted class code for each detection, or -1 if it has no classification results
+        classification_id_to_code = np.array(
+            [classname_to_code.setdefault(classification_categories_map[classification_id], len(classname_to_code))
+             for classification_id in detection_arrays.classification_category_ids] + [-1], dtype=np.int64)
+        pred_codes = classification_id_to_code[detection_arrays.classification_category]
+        
+        # Unique (image, predicted class) pairs for the images we can evaluate, i.e. images 
+        # with classification predictions and an unambiguous class annotated, sorted by image
+        n_codes = max(len(classname_to_code), 1)
+        b_evaluated_detection = (pred_codes >= 0) & (gt_codes[detection_arrays.image_index] >= 0)
+        pair_keys = np.unique(detection_arrays.image_index[b_evaluated_detection].astype(np.int64) * n_codes
+                              + pred_codes[b_evaluated_detection])
+        pair_images = pair_keys // n_codes
+        pair_pred_codes = pair_keys % n_codes
+        
+        n_pred_categories = np.bincount(pair_images, minlength=len(gt_images))
+        evaluated_images = np.flatnonzero(n_pred_categories > 0)
+        
+        # Compute the accuracy as intersection of union,
+        # i.e. (# of categories in both prediciton and GT)
+        #      divided by (# of categories in either prediction or GT
+        #
+        # In case of only one GT category, the result will be 1.0, if
+        # prediction is one category and this category matches GT
         #
-        # Rows / first index is ground truth, columns / second index is predicted category
-        classifier_cm = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+        # It is 1.0/(# of predicted top-1 categories), if the GT is
+        # one of the predicted top-1 categories.
+        #
+        # It is 0.0, if none of the predicted categories is correct
+        b_gt_predicted = np.isin(evaluated_images * n_codes + gt_codes[evaluated_images], pair_keys)
+        classifier_accuracies = (b_gt_predicted / 
+                                 (n_pred_categories[evaluated_images] + ~b_gt_predicted)).tolist()
+        for i_image, accuracy in zip(evaluated_images, classifier_accuracies):
+            gt_images[i_image]['_classification_accuracy'] = accuracy
         
-        # iDetection = 0; fn = detector_files[iDetection]; print(fn)
-        assert len(detector_files) == len(detection_results)
-        for iDetection,fn in enumerate(detector_files):
-            
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detections = detection_results['detections'].iloc[iDetection]
-            pred_class_ids = [det['classifications'][0][0] \
-                for det in detections if 'classifications' in det.keys()]
-            pred_classnames = [classification_categories_map[pd] for pd in pred_class_ids]
-
-            # If this image has classification predictions, and an unambiguous class
-            # annotated, and is a positive image...
-            if len(pred_classnames) > 0 \
-                    and '_unambiguous_category' in image.keys() \
-                    and image['_detection_status'] == DetectionStatus.DS_POSITIVE:
-                        
-                # The unambiguous category, we make this a set for easier handling afterward
-                gt_categories = set([image['_unambiguous_category']])
-                pred_categories = set(pred_classnames)
-                
-                # Compute the accuracy as intersection of union,
-                # i.e. (# of categories in both prediciton and GT)
-                #      divided by (# of categories in either prediction or GT
-                #
-                # In case of only one GT category, the result will be 1.0, if
-                # prediction is one category and this category matches GT
-                #
-                # It is 1.0/(# of predicted top-1 categories), if the GT is
-                # one of the predicted top-1 categories.
-                #
-                # It is 0.0, if none of the predicted categories is correct
-                
-                classifier_accuracies.append(
-                    len(gt_categories & pred_categories)
-                    / len(gt_categories | pred_categories)
-                )
-                image['_classification_accuracy'] = classifier_accuracies[-1]
-                
-                # Distribute this accuracy across all predicted categories in the
-                # confusion matrix
-                assert len(gt_categories) == 1
-                gt_class_idx = classname_to_idx[list(gt_categories)[0]]
-                for pred_category in pred_categories:
-                    pred_class_idx = classname_to_idx[pred_category]
-                    classifier_cm[gt_class_idx][pred_class_idx] += 1
-
-        # ...for each file in the detection results
+        # Mapping of classnames to idx for the confusion matrix, in alphabetical order, 
+        # over the classes that appear (as ground truth or prediction) in evaluated images
+        code_to_classname = {code: classname for classname, code in classname_to_code.items()}
+        seen_codes = np.unique(np.concatenate([gt_codes[evaluated_images], pair_pred_codes]))
+        classname_list = sorted(code_to_classname[code] for code in seen_codes.tolist())
+        classname_to_idx = {classname: idx for idx, classname in enumerate(classname_list)}
         
         # If we have classification results
         if len(classifier_accuracies) > 0:
             
-            # Build confusion matrix as array from classifier_cm
-            all_class_ids = sorted(classname_to_idx.values())
-            classifier_cm_array = np.array(
-                [[classifier_cm[r_idx][c_idx] for c_idx in all_class_ids] for r_idx in all_class_ids], dtype=float)
+            # Build confusion matrix as array, distributing each image's accuracy across 
+            # all its predicted categories; rows / first index is ground truth, columns / 
+            # second index is predicted category
+            code_to_idx = np.zeros(n_codes, dtype=np.int64)
+            for classname, idx in classname_to_idx.items():
+                code_to_idx[classname_to_code[classname]] = idx
+            classifier_cm_array = np.zeros((len(classname_list), len(classname_list)), dtype=float)
+            np.add.at(classifier_cm_array, 
+                      (code_to_idx[gt_codes[pair_images]], code_to_idx[pair_pred_codes]), 1)
             classifier_cm_array /= (classifier_cm_array.sum(axis=1, keepdims=True) + 1e-7)
 
             # Print some statistics
@@ -631,8 +1254,6 @@ def process_batch_results(options):
             np.savetxt(sio, classifier_cm_array * 100, fmt='%5.1f')
             cm_str = sio.getvalue()
             # Get fixed-size classname for each idx
-            idx_to_classname = {v:k for k,v in classname_to_idx.items()}
-            classname_list = [idx_to_classname[idx] for idx in sorted(classname_to_idx.values())]
             classname_headers = ['{:<5}'.format(cname[:5]) for cname in classname_list]
 
             # Prepend class name on each line and add to the top
@@ -660,7 +1281,8 @@ def process_batch_results(options):
                             y_label=True)
             cm_figure_relative_filename = 'confusion_matrix.png'
             cm_figure_filename = os.path.join(output_dir, cm_figure_relative_filename)
-            plt.savefig(cm_figure_filename)
+            fig.savefig(cm_figure_filename)
+            fig.clf()
             plt.close(fig)
 
         # ...if we have classification results
@@ -678,9 +1300,15 @@ def process_batch_results(options):
         fig = vis_utils.plot_precision_recall_curve(precisions, recalls, t)
         pr_figure_relative_filename = 'prec_recall.png'
         pr_figure_filename = os.path.join(output_dir, pr_figure_relative_filename)
-        plt.savefig(pr_figure_filename)
+        fig.savefig(pr_figure_filename)
         # plt.show(block=False)
+        fig.clf()
         plt.close(fig)
+        
+        # pyplot can hold on to figure memory until the next garbage collection, which
+        # adds up when we're called repeatedly in one process
+        plt.close('all')
+        gc.collect()
 
 
         ##%% Sampling
@@ -689,120 +1317,71 @@ def process_batch_results(options):
         # classification and render to html
 
         # Accumulate html image structs (in the format expected by write_html_image_lists)
-        # for each category, e.g. 'tp', 'fp', ..., 'class_bird', ...
-        images_html = collections.defaultdict(lambda: [])
-        # Add default entries by accessing them for the first time
-        [images_html[res] for res in ['tp', 'tpc', 'tpi', 'fp', 'tn', 'fn']]  # Siyu: what does this do? This line should have no effect
+        # for each category, e.g. 'tp', 'fp', ..., 'class_bird', ...; the result types 
+        # always get a page, class pages are added as we encounter them
+        images_html = {res: [] for res in ['tp', 'tpc', 'tpi', 'fp', 'tn', 'fn']}
         for res in images_html.keys():
             os.makedirs(os.path.join(output_dir, res), exist_ok=True)
 
         image_count = len(images_to_visualize)
-
-        # Each element will be a list of 2-tuples, with elements [collection name,html info struct]
-        rendering_results = []
         
-        # Each element will be a three-tuple with elements file,max_conf,detections
-        files_to_render = []
+        # Look up the ground truth for each sampled image, then assign all the result 
+        # types at once.  Filenames should already have been normalized to either '/' or '\'
+        sample_files = images_to_visualize['file'].to_numpy()
+        sample_max_conf = images_to_visualize['max_detection_conf'].to_numpy()
+        sample_image_ids = [ground_truth_indexed_db.filename_to_id.get(fn, None) 
+                            for fn in sample_files]
+        sample_gt_presence = np.zeros(image_count, dtype=bool)
+        sample_accuracy = np.full(image_count, np.nan)
+        for i_image, image_id in enumerate(sample_image_ids):
+            if image_id is not None:
+                image = ground_truth_indexed_db.image_id_to_image[image_id]
+                sample_gt_presence[i_image] = bool(image['_detection_status'])
+                sample_accuracy[i_image] = image.get('_classification_accuracy', np.nan)
+        sample_result_types = get_sample_result_types(sample_gt_presence, sample_max_conf,
+                                                      sample_accuracy, options)
         
-        # Assemble the information we need for rendering, so we can parallelize without
-        # dealing with Pandas
-        # i_row = 0; row = images_to_visualize.iloc[0]
-        for _, row in images_to_visualize.iterrows():
-
-            # Filenames should already have been normalized to either '/' or '\'
-            files_to_render.append([row['file'],row['max_detection_conf'],row['detections']])
-            
-        def render_image_with_gt(file_info):
-
-            image_relative_path = file_info[0]
-            max_conf = file_info[1]
-            detections = file_info[2]
-
-            # This should already have been normalized to either '/' or '\'
-
-            image_id = ground_truth_indexed_db.filename_to_id.get(image_relative_path, None)
-            if image_id is None:
-                print('Warning: couldn''t find ground truth for image {}'.format(image_relative_path))
-                return None
-
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            annotations = ground_truth_indexed_db.image_id_to_annotations[image_id]
-
-            gt_status = image['_detection_status']
-
-            gt_presence = bool(gt_status)
-
-            gt_classes = CameraTrapJsonUtils.annotations_to_classnames(
-                    annotations,ground_truth_indexed_db.cat_id_to_name)
-            gt_class_summary = ','.join(gt_classes)
-
-            if gt_status > DetectionStatus.DS_MAX_DEFINITIVE_VALUE:
-                print('Skipping image {}, does not have a definitive ground truth status (status: {}, classes: {})'.format(
-                        image_id, gt_status, gt_class_summary))
-                return None
-
-            detected = max_conf > options.confidence_threshold
-
-            if gt_presence and detected:
-                if '_classification_accuracy' not in image.keys():
-                    res = 'tp'
-                elif np.isclose(1, image['_classification_accuracy']):
-                    res = 'tpc'
-                else:
-                    res = 'tpi'
-            elif not gt_presence and detected:
-                res = 'fp'
-            elif gt_presence and not detected:
-                res = 'fn'
-            else:
-                res = 'tn'
-
-            display_name = '<b>Result type</b>: {}, <b>Presence</b>: {}, <b>Class</b>: {}, <b>Max conf</b>: {:0.2f}%, <b>Image</b>: {}'.format(
-                res.upper(), str(gt_presence), gt_class_summary,
-                max_conf * 100, image_relative_path)
-
-            rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
-                                                                image_relative_path,
-                                                                display_name,
-                                                                detections,
-                                                                res,
-                                                                detection_categories_map,
-                                                                classification_categories_map,
-                                                                options)
-
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res,rendered_image_html_info]]
-                for gt_class in gt_classes:
-                    image_result.append(['class_{}'.format(gt_class),rendered_image_html_info])
-            
-            return image_result
+        def files_to_render():
+            """
+            Yields the information we need for rendering, including the ground truth for
+            each image, so we can parallelize without dealing with Pandas or sending the
+            whole ground truth database to each worker.  Each element is a list with 
+            elements file,max_conf,detections,image_id,image,gt_classes,res.
+            """
             
-        # ...def render_image_with_gt(file_info)
+            for fn, max_conf, detections, image_id, res in zip(
+                    sample_files, sample_max_conf, images_to_visualize['detections'].to_numpy(),
+                    sample_image_ids, sample_result_types):
+                image = None
+                gt_classes = None
+                if image_id is not None:
+                    image = ground_truth_indexed_db.image_id_to_image[image_id]
+                    gt_classes = ground_truth_indexed_db.get_classnames_for_image(image)
+                yield [fn,max_conf,detections,image_id,image,gt_classes,res]
         
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_with_gt, files_to_render), total=len(files_to_render)))    
-        else:
-            # file_info = files_to_render[0]
-            for file_info in tqdm(files_to_render):        
-                rendering_results.append(render_image_with_gt(file_info))
-        elapsed = time.time() - start_time
+        class_name_to_html_key = {cname: 'class_{}'.format(cname) for cname in 
+                                  ground_truth_indexed_db.cat_id_to_name.values()}
+        render_function = partial(render_image_with_gt,
+                                  detection_categories_map=detection_categories_map,
+                                  classification_categories_map=classification_categories_map,
+                                  options=options,
+                                  class_name_to_html_key=class_name_to_html_key)
         
-        # Map all the rendering results in the list rendering_results into the 
-        # dictionary images_html
+        # Map each rendering result, a list of 2-tuples with elements 
+        # [collection name,html info struct], into the dictionary images_html as it 
+        # becomes available
         image_rendered_count = 0
-        for rendering_result in rendering_results:
+        for rendering_result in render_images(render_function, files_to_render(), 
+                                              image_count, options):
             if rendering_result is None:
                 continue
             image_rendered_count += 1
             for assignment in rendering_result:
+                if assignment[0] not in images_html:
+                    images_html[assignment[0]] = []
                 images_html[assignment[0]].append(assignment[1])
+        elapsed = time.time() - start_time
                 
         # Prepare the individual html image files
         image_counts = prepare_html_subpages(images_html, output_dir)
@@ -813,96 +1392,60 @@ def process_batch_results(options):
         all_tp_count = image_counts['tp'] + image_counts['tpc'] + image_counts['tpi']
         total_count = all_tp_count + image_counts['tn'] + image_counts['fp'] + image_counts['fn']
         
-        classification_detection_results = """&nbsp;&nbsp;&nbsp;&nbsp;<a href="tpc.html">with all correct top-1 predictions (TPC)</a> ({})<br/>
-           &nbsp;&nbsp;&nbsp;&nbsp;<a href="tpi.html">with one or more incorrect top-1 prediction (TPI)</a> ({})<br/>
-           &nbsp;&nbsp;&nbsp;&nbsp;<a href="tp.html">without classification evaluation</a><sup>*</sup> ({})<br/>""".format(
-            image_counts['tpc'],
-            image_counts['tpi'],
-            image_counts['tp']            
-        )
+        # Fill in the classification summary lines up front, rather than replacing
+        # placeholders in the finished page
+        classification_summary = ''
+        classification_footnote = ''
+        if len(classifier_accuracies) > 0:
+            classification_summary = GT_INDEX_PAGE_CLASSIFICATION_SUMMARY_TEMPLATE.format(
+                tpc_count=image_counts['tpc'], tpi_count=image_counts['tpi'], 
+                tp_count=image_counts['tp'])
+            classification_footnote = GT_INDEX_PAGE_CLASSIFICATION_FOOTNOTE
         
-        index_page = """<html>
-        {}
-        <body>
-        <h2>Evaluation</h2>
-
-        <h3>Sample images</h3>
-        <div style="margin-left:20px;">
-        <p>A sample of {} images, annotated with detections above {:.1%} confidence.</p>
-        <a href="tp.html">True positives (TP)</a> ({}) ({:0.1%})<br/>
-        CLASSIFICATION_PLACEHOLDER_1
-        <a href="tn.html">True negatives (TN)</a> ({}) ({:0.1%})<br/>
-        <a href="fp.html">False positives (FP)</a> ({}) ({:0.1%})<br/>
-        <a href="fn.html">False negatives (FN)</a> ({}) ({:0.1%})<br/>
-        CLASSIFICATION_PLACEHOLDER_2
-        </div>        
-        """.format(
-            style_header,
-            image_count, options.confidence_threshold,
-            all_tp_count, all_tp_count/total_count,
-            image_counts['tn'], image_counts['tn']/total_count,
-            image_counts['fp'], image_counts['fp']/total_count,
-            image_counts['fn'], image_counts['fn']/total_count
-        )
+        # Accumulate the page in a list of parts, and join them once at the end
+        index_page_parts = []
+        index_page_parts.append(GT_INDEX_PAGE_HEADER_TEMPLATE.format(
+            style_header=style_header,
+            image_count=image_count, confidence_threshold=options.confidence_threshold,
+            tp_count=all_tp_count, tp_fraction=all_tp_count/total_count,
+            classification_summary=classification_summary,
+            tn_count=image_counts['tn'], tn_fraction=image_counts['tn']/total_count,
+            fp_count=image_counts['fp'], fp_fraction=image_counts['fp']/total_count,
+            fn_count=image_counts['fn'], fn_fraction=image_counts['fn']/total_count,
+            classification_footnote=classification_footnote
+        ))
         
-        index_page += """
-            <h3>Detection results</h3>
-            <div class="contentdiv">
-            <p>At a confidence threshold of {:0.1%}, precision={:0.1%}, recall={:0.1%}</p>
-            <p><strong>Precision/recall summary for all {} images</strong></p><img src="{}"><br/>
-            </div>
-            """.format(
-                options.confidence_threshold, precision_at_confidence_threshold, recall_at_confidence_threshold,
-                len(detection_results), pr_figure_relative_filename
-           )
-        
-        if len(classifier_accuracies) > 0:
-            index_page = index_page.replace('CLASSIFICATION_PLACEHOLDER_1',classification_detection_results)
-            index_page = index_page.replace('CLASSIFICATION_PLACEHOLDER_2',"""<p><sup>*</sup>We do not evaluate the classification result of images 
-                if the classification information is missing, if the image contains
-                categories like &lsquo;empty&rsquo; or &lsquo;human&rsquo;, or if the image has multiple 
-                classification labels.</p>""")
-        else:
-            index_page = index_page.replace('CLASSIFICATION_PLACEHOLDER_1','')
-            index_page = index_page.replace('CLASSIFICATION_PLACEHOLDER_2','')
+        index_page_parts.append(GT_INDEX_PAGE_DETECTION_RESULTS_TEMPLATE.format(
+            confidence_threshold=options.confidence_threshold, 
+            precision=precision_at_confidence_threshold, recall=recall_at_confidence_threshold,
+            n_images=len(detection_results), pr_figure=pr_figure_relative_filename
+        ))
             
         if len(classifier_accuracies) > 0:
-            index_page += """
-                <h3>Classification results</h3>
-                <div class="contentdiv">
-                <p>Classification accuracy: {:.2%}<br>
-                The accuracy is computed only for images with exactly one classification label.
-                The accuracy of an image is computed as 1/(number of unique detected top-1 classes),
-                i.e. if the model detects multiple boxes with different top-1 classes, then the accuracy
-                decreases and the image is put into 'TPI'.</p>
-                <p>Confusion matrix:</p>
-                <p><img src="{}"></p>
-                <div style='font-family:monospace;display:block;'>{}</div>
-                </div>
-                """.format(
-                    np.mean(classifier_accuracies),
-                    cm_figure_relative_filename,
-                    "<br>".join(cm_str_lines).replace(' ', '&nbsp;')
-                )
+            index_page_parts.append(GT_INDEX_PAGE_CLASSIFICATION_RESULTS_TEMPLATE.format(
+                accuracy=np.mean(classifier_accuracies),
+                cm_figure=cm_figure_relative_filename,
+                cm_text="<br>".join(cm_str_lines).replace(' ', '&nbsp;')
+            ))
                 
         # Show links to each GT class
         #
         # We could do this without classification results; currently we don't.
         if len(classname_to_idx) > 0:
             
-            index_page += '<h3>Images of specific classes</h3><br/><div class="contentdiv">'
+            index_page_parts.append('<h3>Images of specific classes</h3><br/><div class="contentdiv">')
             # Add links to all available classes
             for cname in sorted(classname_to_idx.keys()):
-                index_page += "<a href='class_{0}.html'>{0}</a> ({1})<br>".format(
+                index_page_parts.append("<a href='class_{0}.html'>{0}</a> ({1})<br>".format(
                     cname,
-                    len(images_html['class_{}'.format(cname)]))
-            index_page += "</div>"
+                    len(images_html.get('class_{}'.format(cname), []))))
+            index_page_parts.append("</div>")
             
         # Close body and html tags
-        index_page += "</body></html>"
+        index_page_parts.append("</body></html>")
         output_html_file = os.path.join(output_dir, 'index.html')
         with open(output_html_file, 'w') as f:
-            f.write(index_page)
+            f.write(''.join(index_page_parts))
 
         print('Finished writing html to {}'.format(output_html_file))
 
@@ -916,13 +1459,11 @@ def process_batch_results(options):
         ##%% Sample detections/non-detections
 
         # Accumulate html image structs (in the format expected by write_html_image_lists)
-        # for each category
-        images_html = collections.defaultdict(lambda: [])        
-        
-        # Add default entries by accessing them for the first time
-        [images_html[res] for res in ['detections', 'non_detections']]
+        # for each category; the result types always get a page, class pages are added as
+        # we encounter them
+        images_html = {res: [] for res in ['detections', 'non_detections']}
         if options.include_almost_detections:
-            images_html['almost_detections']
+            images_html['almost_detections'] = []
             
         # Create output directories
         for res in images_html.keys():
@@ -931,98 +1472,40 @@ def process_batch_results(options):
         image_count = len(images_to_visualize)
         has_classification_info = False
         
-        # Each element will be a list of 2-tuples, with elements [collection name,html info struct]
-        rendering_results = []
-
-        # Each element will be a three-tuple with elements file,max_conf,detections
-        files_to_render = []
-        
-        # Assemble the information we need for rendering, so we can parallelize without
-        # dealing with Pandas
-        # i_row = 0; row = images_to_visualize.iloc[0]
-        for _, row in images_to_visualize.iterrows():
-
-            # Filenames should already have been normalized to either '/' or '\'
-            files_to_render.append([row['file'],row['max_detection_conf'],row['detections']])
+        # Each element will be a four-tuple with elements file,max_conf,detections,
+        # detection_status, where we assign the detection status for all images at once; 
+        # filenames should already have been normalized to either '/' or '\'
+        sample_max_conf = images_to_visualize['max_detection_conf'].to_numpy()
+        files_to_render = zip(images_to_visualize['file'].to_numpy(),
+                              sample_max_conf,
+                              images_to_visualize['detections'].to_numpy(),
+                              get_pred_detection_labels(sample_max_conf, options).tolist())
             
-        # Local function for parallelization
-        def render_image_no_gt(file_info):
-            
-            image_relative_path = file_info[0]
-            max_conf = file_info[1]
-            detections = file_info[2]
-            
-            detection_status = DetectionStatus.DS_UNASSIGNED            
-            if max_conf >= options.confidence_threshold:
-                detection_status = DetectionStatus.DS_POSITIVE
-            else:
-                if options.include_almost_detections:
-                    if max_conf >= options.almost_detection_confidence_threshold:
-                        detection_status = DetectionStatus.DS_ALMOST
-                    else:
-                        detection_status = DetectionStatus.DS_NEGATIVE
-                else:
-                    detection_status = DetectionStatus.DS_NEGATIVE
-            
-            if detection_status == DetectionStatus.DS_POSITIVE:
-                res = 'detections'
-            elif detection_status == DetectionStatus.DS_NEGATIVE:
-                res = 'non_detections'
-            else:
-                assert detection_status == DetectionStatus.DS_ALMOST
-                res = 'almost_detections'
-
-            display_name = '<b>Result type</b>: {}, <b>Image</b>: {}, <b>Max conf</b>: {}'.format(
-                res, image_relative_path, max_conf)
-
-            rendering_options = copy.copy(options)
-            if detection_status == DetectionStatus.DS_ALMOST:
-                rendering_options.confidence_threshold = rendering_options.almost_detection_confidence_threshold
-            rendered_image_html_info = render_bounding_boxes(options.image_base_dir,
-                                                                image_relative_path,
-                                                                display_name,
-                                                                detections,
-                                                                res,
-                                                                detection_categories_map,
-                                                                classification_categories_map,
-                                                                rendering_options)
-            
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res,rendered_image_html_info]]
-                for det in detections:
-                    if 'classifications' in det:
-                        top1_class = classification_categories_map[det['classifications'][0][0]]
-                        image_result.append(['class_{}'.format(top1_class),rendered_image_html_info])
-            
-            return image_result
-        
-        # ...def render_image_no_gt(file_info):
-        
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_no_gt, files_to_render), total=len(files_to_render)))    
-        else:
-            for file_info in tqdm(files_to_render):        
-                rendering_results.append(render_image_no_gt(file_info))            
-        elapsed = time.time() - start_time
+        classification_category_to_html_key = {
+            cat_id: 'class_{}'.format(cname) for cat_id, cname in classification_categories_map.items()}
+        render_function = partial(render_image_no_gt,
+                                  detection_categories_map=detection_categories_map,
+                                  classification_categories_map=classification_categories_map,
+                                  options=options,
+                                  classification_category_to_html_key=classification_category_to_html_key)
         
-        # Map all the rendering results in the list rendering_results into the 
-        # dictionary images_html
+        # Map each rendering result, a list of 2-tuples with elements 
+        # [collection name,html info struct], into the dictionary images_html as it 
+        # becomes available
         image_rendered_count = 0
-        for rendering_result in rendering_results:
+        for rendering_result in render_images(render_function, files_to_render, 
+                                              image_count, options):
             if rendering_result is None:
                 continue
             image_rendered_count += 1
             for assignment in rendering_result:
                 if 'class' in assignment[0]:
                     has_classification_info = True
+                if assignment[0] not in images_html:
+                    images_html[assignment[0]] = []
                 images_html[assignment[0]].append(assignment[1])
+        elapsed = time.time() - start_time
                 
         # Prepare the individual html image files
         image_counts = prepare_html_subpages(images_html, output_dir)
@@ -1041,39 +1524,39 @@ def process_batch_results(options):
         if options.include_almost_detections:
             almost_detection_string = ' (&ldquo;almost detection&rdquo; threshold at {:.1%})'.format(options.almost_detection_confidence_threshold)
             
-        index_page = """<html>{}<body>
-        <h2>Visualization of results</h2>
-        <p>A sample of {} images, annotated with detections above {:.1%} confidence{}.</p>
-        <h3>Sample images</h3>
-        <div class="contentdiv">
-        <a href="detections.html">detections</a> ({}, {:.1%})<br/>
-        <a href="non_detections.html">non-detections</a> ({}, {:.1%})<br/>""".format(
-            style_header,image_count, options.confidence_threshold, almost_detection_string,
-            image_counts['detections'], image_counts['detections']/total_images,
-            image_counts['non_detections'], image_counts['non_detections']/total_images
-        )
+        # Accumulate the page in a list of parts, and join them once at the end
+        index_page_parts = []
+        index_page_parts.append(NO_GT_INDEX_PAGE_HEADER_TEMPLATE.format(
+            style_header=style_header, image_count=image_count, 
+            confidence_threshold=options.confidence_threshold, 
+            almost_detection_string=almost_detection_string,
+            detections_count=image_counts['detections'], 
+            detections_fraction=image_counts['detections']/total_images,
+            non_detections_count=image_counts['non_detections'], 
+            non_detections_fraction=image_counts['non_detections']/total_images
+        ))
         
         if options.include_almost_detections:
-            index_page += """<a href="almost_detections.html">almost-detections</a> ({}, {:.1%})<br/>""".format( 
-                    image_counts['almost_detections'], image_counts['almost_detections']/total_images)
+            index_page_parts.append("""<a href="almost_detections.html">almost-detections</a> ({}, {:.1%})<br/>""".format( 
+                    image_counts['almost_detections'], image_counts['almost_detections']/total_images))
         
-        index_page += '</div>\n'
+        index_page_parts.append('</div>\n')
         
         if has_classification_info:
-            index_page += "<h3>Images of detected classes</h3>"
-            index_page += "<p>The same image might appear under multiple classes if multiple species were detected.</p>\n<div class='contentdiv'>\n"
+            index_page_parts.append("<h3>Images of detected classes</h3>")
+            index_page_parts.append("<p>The same image might appear under multiple classes if multiple species were detected.</p>\n<div class='contentdiv'>\n")
         
             # Add links to all available classes
             for cname in sorted(classification_categories_map.values()):
-                ccount = len(images_html['class_{}'.format(cname)])
+                ccount = len(images_html.get('class_{}'.format(cname), []))
                 if ccount > 0:
-                    index_page += "<a href='class_{}.html'>{}</a> ({})<br/>\n".format(cname, cname.lower(), ccount)
-            index_page += "</div>\n"
+                    index_page_parts.append("<a href='class_{}.html'>{}</a> ({})<br/>\n".format(cname, cname.lower(), ccount))
+            index_page_parts.append("</div>\n")
             
-        index_page += "</body></html>"
+        index_page_parts.append("</body></html>")
         output_html_file = os.path.join(output_dir, 'index.html')
         with open(output_html_file, 'w') as f:
-            f.write(index_page)
+            f.write(''.join(index_page_parts))
 
         print('Finished writing html to {}'.format(output_html_file))
 
@@ -1134,6 +1617,10 @@ def main():
     parser.add_argument('--viz_target_width', action='store', type=int, default=default_options.viz_target_width,
                         help='Output image width')
     parser.add_argument('--random_output_sort', action='store_true', help='Sort output randomly (defaults to sorting by filename)')
+    parser.add_argument('--use_api_output_parquet_cache', action='store_true',
+                        help='Cache parsed API output as .parquet next to the API output file, and re-use it on later runs (requires pyarrow)')
+    parser.add_argument('--decode_with_opencv', action='store_true',
+                        help='Decode and resize sample images with OpenCV, which parallelizes better across threads (requires opencv-python)')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
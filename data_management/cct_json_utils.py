@@ -17,6 +17,13 @@ import os
 import json
 from collections import defaultdict
 
+# orjson is optional, but parses large databases several times faster than json
+try:
+    import orjson
+    b_orjson_available = True
+except ImportError:
+    b_orjson_available = False
+
 
 #%% Classes
 
@@ -91,41 +98,71 @@ class IndexedJsonDb:
         if self.db is None:
             return None
     
-        if image['id'] not in self.image_id_to_annotations:
-            return []
-        
-        class_ids = []
-        image_annotations = self.image_id_to_annotations[image['id']]
-        for ann in image_annotations:
-            class_ids.append(ann['category_id'])
-        class_ids = list(set(class_ids))
-        class_ids.sort()
+        # Use .get() rather than indexing, so we don't add an empty list to the 
+        # defaultdict for images without annotations
+        class_ids = sorted({ann['category_id'] for ann in 
+                            self.image_id_to_annotations.get(image['id'], ())})
         class_names = [self.cat_id_to_name[x] for x in class_ids]
         
         return class_names
         
         
+    def get_classnames_for_image(self, image):
+        """
+        Returns the alphabetically-sorted list of unique class names associated with 
+        [image], as per CameraTrapJsonUtils.annotations_to_classnames.  Results are cached
+        by image ID, so callers should not modify the returned list.
+        
+        Returns None is the db has not been loaded, [] if no annotations are available
+        """
+        
+        if self.db is None:
+            return None
+        
+        image_id = image['id']
+        class_names = self._classnames_cache.get(image_id, None)
+        if class_names is None:
+            class_names = CameraTrapJsonUtils.annotations_to_classnames(
+                self.image_id_to_annotations.get(image_id, []), self.cat_id_to_name)
+            self._classnames_cache[image_id] = class_names
+        
+        return class_names
+        
+        
     def __init__(self, json_filename, b_normalize_paths=False, filename_replacements={}):
         '''
         json_filename can also be an existing json db
         '''
         
         if isinstance(json_filename,str):
-            self.db = json.load(open(json_filename))
+            self.db = None
+            if b_orjson_available:
+                with open(json_filename, 'rb') as f:
+                    try:
+                        self.db = orjson.loads(f.read())
+                    except orjson.JSONDecodeError:
+                        # orjson is stricter than json, e.g. it doesn't accept the NaN 
+                        # values json.dump writes by default
+                        pass
+            if self.db is None:
+                with open(json_filename) as f:
+                    self.db = json.load(f)
         else:
             self.db = json_filename
     
         assert 'images' in self.db, 'Could not find image list in file {}, are you sure this is a COCO camera traps file?'.format(json_filename)
         
-        if b_normalize_paths:
-            # Normalize paths to simplify comparisons later
+        # Normalize paths (to simplify comparisons later) and apply replacements in a 
+        # single pass over the images
+        replacements = list(filename_replacements.items())
+        if b_normalize_paths or len(replacements) > 0:
             for im in self.db['images']:
-                im['file_name'] = os.path.normpath(im['file_name'])
-
-        for s in filename_replacements:
-            r = filename_replacements[s]
-            for im in self.db['images']:
-                im['file_name'] = im['file_name'].replace(s, r)
+                fn = im['file_name']
+                if b_normalize_paths:
+                    fn = os.path.normpath(fn)
+                for s, r in replacements:
+                    fn = fn.replace(s, r)
+                im['file_name'] = fn
         
         ### Build useful mappings to facilitate working with the DB
 
@@ -142,7 +179,14 @@ class IndexedJsonDb:
         # Image ID --> image object
         self.image_id_to_image = {im['id']: im for im in self.db['images']}
         
+        # Image ID --> sorted class names, filled in by get_classnames_for_image
+        self._classnames_cache = {}
+        
         # Image ID --> annotations
+        #
+        # This single bucketing pass is as fast as the alternatives we've tried (sorting
+        # and grouping, pre-seeding a list per image, setdefault), and unlike sorting
+        # it preserves annotation order without extra work.
         for ann in self.db['annotations']:
             self.image_id_to_annotations[ann['image_id']].append(ann)
 
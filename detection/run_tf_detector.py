@@ -11,8 +11,8 @@
 # get super-satisfying, graphical results.  It's also a good way to see how
 # fast a detector model will run on a particular machine.
 #
-# This script is not a good way to process lots and lots of images; it loads all
-# the images first, then runs the model.  If you want to run a detector (e.g. ours)
+# This script is not a good way to process lots and lots of images; it doesn't
+# write out the detections, just the rendered images.  If you want to run a detector (e.g. ours)
 # on lots of images, you should check out:
 #
 # 1) run_tf_detector_batch.py (for local execution)
@@ -34,25 +34,59 @@ import glob
 import os
 import sys
 import time
+from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
 
 import PIL
 import humanfriendly
 import matplotlib
 matplotlib.use('TkAgg')
+import matplotlib.colors
 import matplotlib.image as mpimg
 import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import numpy as np
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 from tqdm import tqdm
 
+# OpenCV draws boxes much faster than matplotlib; we fall back to matplotlib if it's 
+# not available
+try:
+    import cv2
+    bOpenCVAvailable = True
+except ImportError:
+    bOpenCVAvailable = False
+
+# simplejpeg (libjpeg-turbo) decodes JPEGs directly to RGB arrays, faster than PIL
+try:
+    import simplejpeg
+    bSimpleJpegAvailable = True
+except ImportError:
+    bSimpleJpegAvailable = False
+
 DEFAULT_CONFIDENCE_THRESHOLD = 0.85
 
+# Number of images to run through the detector at once; only images of the same
+# size are batched together
+DEFAULT_BATCH_SIZE = 1
+
+# Maximum number of threads used to load images; PIL releases the GIL while decoding
+MAX_LOADER_THREADS = 16
+
 # Stick this into filenames before the extension for the rendered result
 DETECTION_FILENAME_INSERT = '_detections'
 
+# Number of input images used to calibrate INT8 TensorRT engines
+NUM_INT8_CALIBRATION_IMAGES = 16
+
+# Names of the detector's output nodes
+DETECTOR_OUTPUT_NODES = ['detection_boxes','detection_scores','detection_classes','num_detections']
+
 BOX_COLORS = ['b','g','r']
+BOX_COLORS_BGR = [tuple(int(round(255 * c)) for c in reversed(matplotlib.colors.to_rgb(color))) 
+                  for color in BOX_COLORS]
 DEFAULT_LINE_WIDTH = 10
 SHOW_CONFIDENCE_VALUES = False
 
@@ -63,9 +97,14 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 #%% Core detection functions
 
-def load_model(checkpoint):
+def load_model(checkpoint,bUseTensorRT=False,maxBatchSize=DEFAULT_BATCH_SIZE,bUseFp16=False,
+               calibrationImages=None):
     """
     Load a detection model (i.e., create a graph) from a .pb file
+    
+    If [bUseTensorRT] is True, converts the graph with convert_graph_to_tensorrt before 
+    loading it, with FP16 precision if [bUseFp16] is True, or INT8 precision if 
+    [calibrationImages] is supplied.
     """
 
     detection_graph = tf.Graph()
@@ -74,43 +113,116 @@ def load_model(checkpoint):
         with tf.gfile.GFile(checkpoint, 'rb') as fid:
             serialized_graph = fid.read()
             od_graph_def.ParseFromString(serialized_graph)
+            if bUseTensorRT:
+                od_graph_def = convert_graph_to_tensorrt(od_graph_def,maxBatchSize=maxBatchSize,
+                                                         bUseFp16=bUseFp16,
+                                                         calibrationImages=calibrationImages)
             tf.import_graph_def(od_graph_def, name='')
     
     return detection_graph
 
 
-def generate_detections(detection_graph,images):
+def convert_graph_to_tensorrt(graph_def,maxBatchSize=DEFAULT_BATCH_SIZE,bUseFp16=False,
+                              calibrationImages=None):
     """
-    boxes,scores,classes,images = generate_detections(detection_graph,images)
-
-    Run an already-loaded detector network on a set of images.
+    Replaces the supported parts of the frozen detector [graph_def] with TensorRT engines, 
+    which run considerably faster on NVIDIA GPUs (TensorRT also picks its own memory 
+    layout, so we don't need to convert the graph to NCHW ourselves).  Requires a 
+    TensorFlow build with TensorRT support.
+    
+    If [bUseFp16] is True, engines run in half precision.
+    
+    If [calibrationImages] (a list of filenames or numpy arrays) is supplied, engines run in 
+    INT8 precision, with quantization ranges calibrated by running the detector on those 
+    images, which should be representative of the images we're going to process.
+    """
+    
+    # Only available in TensorRT-enabled TensorFlow builds
+    from tensorflow.python.compiler.tensorrt import trt_convert as trt
+    
+    bCalibrate = calibrationImages is not None
+    if bCalibrate:
+        precisionMode = 'INT8'
+    elif bUseFp16:
+        precisionMode = 'FP16'
+    else:
+        precisionMode = 'FP32'
+    
+    # The input size isn't fixed, so engines have to be built at run time
+    converter = trt.TrtGraphConverter(input_graph_def=graph_def,
+                                      nodes_blacklist=DETECTOR_OUTPUT_NODES,
+                                      max_batch_size=maxBatchSize,
+                                      precision_mode=precisionMode,
+                                      use_calibration=bCalibrate,
+                                      is_dynamic_op=True)
+    graph_def = converter.convert()
+    
+    if bCalibrate:
+        calibrationImageIterator = iter(calibrationImages)
+        graph_def = converter.calibrate(
+            fetch_names=[nodeName + ':0' for nodeName in DETECTOR_OUTPUT_NODES],
+            num_runs=len(calibrationImages),
+            feed_dict_fn=lambda: {'image_tensor:0': np.expand_dims(load_image(next(calibrationImageIterator)),axis=0)})
+        
+    return graph_def
 
-    [images] can be a list of numpy arrays or a list of filenames.  Non-list inputs will be
-    wrapped into a list.
 
-    Boxes are returned in relative coordinates as (top, left, bottom, right); 
-    x,y origin is the upper-left.
-    
-    [boxes] will be returned as a numpy array of size nImages x nDetections x 4.
+def get_session_config(bEnableXla=False,bUseMixedPrecision=False,bForceCpu=False):
+    """
+    Returns the tf.ConfigProto used to run the detector.  If [bEnableXla] is True, turns 
+    on XLA JIT compilation, which fuses detector ops into fewer kernels, at the cost of
+    compiling the graph for each new image size.
     
-    [scores] and [classes] will each be returned as a numpy array of size nImages x nDetections.
+    If [bUseMixedPrecision] is True, lets TensorFlow run ops that are safe to run in
+    FP16 in FP16, which is much faster on GPUs with tensor cores.
     
-    [images] is a set of numpy arrays corresponding to the input parameter [images], which may have
-    have been either arrays or filenames.    
+    If [bForceCpu] is True, tunes thread counts for running on the CPU: the detector is
+    mostly one long chain of convolutions, so we give each op all the cores rather than
+    running many ops at once.
     """
-
-    if not isinstance(images,list):
-        images = [images]
+    
+    if bForceCpu:
+        config = tf.ConfigProto(intra_op_parallelism_threads=os.cpu_count() or 0,
+                                inter_op_parallelism_threads=2)
     else:
-        images = images.copy()
+        config = tf.ConfigProto()
+    
+    # Don't claim all the GPU memory up front
+    config.gpu_options.allow_growth = True
+    
+    if bEnableXla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        
+    if bUseMixedPrecision:
+        config.graph_options.rewrite_options.auto_mixed_precision = \
+            rewriter_config_pb2.RewriterConfig.ON
+        
+    return config
+
 
-    print('Loading images...')
-    startTime = time.time()
+def load_image(image):
+    """
+    Loads [image] as a numpy array of size h,w,3 if it's a filename; numpy arrays are 
+    returned as is.
+    """
     
-    # Load images if they're not already numpy arrays
-    # iImage = 0; image = images[iImage]
-    for iImage,image in enumerate(tqdm(images)):
-        if isinstance(image,str):
+    if isinstance(image,str):
+        
+        fn = image
+        image = None
+        
+        if bSimpleJpegAvailable and os.path.splitext(fn)[1].lower() in ('.jpg','.jpeg'):
+            
+            with open(fn,'rb') as f:
+                imageBytes = f.read()
+                
+            # Fall back to PIL for anything simplejpeg can't decode
+            try:
+                image = simplejpeg.decode_jpeg(imageBytes, colorspace='RGB')
+            except ValueError:
+                image = None
+        
+        if image is None:
             
             # Load the image as an nparray of size h,w,nChannels
             
@@ -121,126 +233,219 @@ def generate_detections(detection_graph,images):
             #
             # So if you find a bug related to using PIL, update this comment
             # to indicate what it was, but also disable .png support.
-            image = PIL.Image.open(image).convert("RGB"); image = np.array(image)
-            # image = mpimg.imread(image)
+            pilImage = PIL.Image.open(fn)
             
-            # This shouldn't be necessary when loading with PIL and converting to RGB
-            nChannels = image.shape[2]
-            if nChannels > 3:
-                print('Warning: trimming channels from image')
-                image = image[:,:,0:3]
-            images[iImage] = image
-        else:
-            assert isinstance(image,np.ndarray)
+            # convert() always makes a copy, even if the image is already RGB
+            if pilImage.mode != 'RGB':
+                pilImage = pilImage.convert('RGB')
+            image = np.array(pilImage)
+            # image = mpimg.imread(fn)
+        
+        # Both decoders always give us RGB
+        assert image.ndim == 3 and image.shape[2] == 3
+        
+    else:
+        assert isinstance(image,np.ndarray)
+        
+    return image
 
-    elapsed = time.time() - startTime
-    print("Finished loading {} file(s) in {}".format(len(images),
-          humanfriendly.format_timespan(elapsed)))    
+
+def load_images(images,loaderPool,nImagesToPrefetch):
+    """
+    Yields the images in [images], loaded via load_image on [loaderPool], in order.  At 
+    most [nImagesToPrefetch] images are loaded ahead of the one most recently yielded,
+    so memory use doesn't grow with the number of images.
+    """
+    
+    pendingImages = deque()
+    
+    for image in images:
+        pendingImages.append(loaderPool.apply_async(load_image,(image,)))
+        if len(pendingImages) > nImagesToPrefetch:
+            yield pendingImages.popleft().get()
+            
+    while len(pendingImages) > 0:
+        yield pendingImages.popleft().get()
+        
+
+def batch_images_by_size(images,batchSize):
+    """
+    Groups the numpy arrays in [images] into batches of up to [batchSize] images of the 
+    same size, yielding each batch as a list of (index,image) tuples as soon as it's full.
+    Incomplete batches are yielded once [images] is exhausted.
+    """
+    
+    pendingBatches = defaultdict(list)
+    
+    for iImage,image in enumerate(images):
+        batch = pendingBatches[image.shape]
+        batch.append((iImage,image))
+        if len(batch) == batchSize:
+            del pendingBatches[image.shape]
+            yield batch
+            
+    for batch in pendingBatches.values():
+        yield batch
+        
+
+def generate_detections(detection_graph,images,batchSize=DEFAULT_BATCH_SIZE,bReturnImages=False,
+                        sessionConfig=None,bVerbose=True,batchCallback=None):
+    """
+    boxes,scores,classes,images = generate_detections(detection_graph,images)
+
+    Run an already-loaded detector network on a set of images.
+
+    [images] can be a list of numpy arrays or a list of filenames.  Non-list inputs will be
+    wrapped into a list.
+    
+    Images of the same size are run through the detector [batchSize] at a time.
     
-    boxes = []
-    scores = []
-    classes = []
+    [sessionConfig] is the tf.ConfigProto to run the detector with, defaulting to 
+    get_session_config().
     
+    If [bVerbose] is False, doesn't print progress or timing information.
+
+    Boxes are returned in relative coordinates as (top, left, bottom, right); 
+    x,y origin is the upper-left.
+    
+    [boxes] will be returned as a numpy array of size nImages x nDetections x 4.
+    
+    [scores] and [classes] will each be returned as a numpy array of size nImages x nDetections.
+    
+    If [bReturnImages] is True, [images] is a set of numpy arrays corresponding to the input 
+    parameter [images], which may have been either arrays or filenames.  Otherwise 
+    [images] is None, and each image is released as soon as the detector has run on it.
+    
+    If [batchCallback] is supplied, it's called after the detector runs on each batch, as:
+    
+    batchCallback(imageIndices,imageBatch,boxes,scores,classes)
+    
+    ...where [imageIndices] are the indices of the batch's images in [images], [imageBatch] 
+    is a list of the corresponding numpy arrays, and [boxes], [scores], and [classes] are 
+    the batch's detections, in the same formats as the return values.  This lets callers
+    use each image (e.g. to render it) without holding on to all the images.
+    """
+
+    if sessionConfig is None:
+        sessionConfig = get_session_config()
+        
+    if not isinstance(images,list):
+        images = [images]
+    elif bReturnImages:
+        images = images.copy()
+
     nImages = len(images)
+    
+    # Allocated once we know how many detections the model returns per image
+    boxes = None
+    scores = None
+    classes = None
+    nDetections = -1
 
-    print('Running detector...')    
-    startTime = time.time()
+    if bVerbose:
+        print('Loading images and running detector...')    
+    startTime = time.perf_counter()
     firstImageCompleteTime = None
+    nImagesInFirstBatch = 0
     
-    with detection_graph.as_default():
+    # Load images (if they're not already numpy arrays) in background threads, so
+    # decoding upcoming images overlaps with running the detector on this one, rather 
+    # than loading all the images before we start running the detector
+    nLoaderThreads = max(1,min(MAX_LOADER_THREADS, os.cpu_count() or 1, nImages))
+    
+    # Exiting the "with" terminates the pool, so any images still being loaded are 
+    # abandoned if the detector fails
+    with ThreadPool(nLoaderThreads) as loaderPool:
         
-        with tf.Session(graph=detection_graph) as sess:
+        loadedImages = load_images(images, loaderPool, max(2*nLoaderThreads,batchSize))
+    
+        with detection_graph.as_default():
+        
+            # Look up the input and output tensors once, rather than for every image
+            image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
+            box_tensor = detection_graph.get_tensor_by_name('detection_boxes:0')
+            score_tensor = detection_graph.get_tensor_by_name('detection_scores:0')
+            class_tensor = detection_graph.get_tensor_by_name('detection_classes:0')
+            num_detections_tensor = detection_graph.get_tensor_by_name('num_detections:0')
+            output_tensors = [box_tensor, score_tensor, class_tensor, num_detections_tensor]
+        
+            with tf.Session(graph=detection_graph,config=sessionConfig) as sess:
             
-            for iImage,imageNP in tqdm(enumerate(images)): 
+                # Bind the fetches and the input placeholder once, so each call skips 
+                # building and validating a feed_dict
+                run_detector = sess.make_callable(output_tensors, feed_list=[image_tensor])
+            
+                progressBar = tqdm(total=nImages,disable=not bVerbose)
+            
+                for batch in batch_images_by_size(loadedImages,batchSize):
+                
+                    if len(batch) == 1:
+                        imageBatch = np.expand_dims(batch[0][1], axis=0)
+                    else:
+                        imageBatch = np.stack([imageNP for _,imageNP in batch], axis=0)
                 
-                imageNP_expanded = np.expand_dims(imageNP, axis=0)
-                image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-                box = detection_graph.get_tensor_by_name('detection_boxes:0')
-                score = detection_graph.get_tensor_by_name('detection_scores:0')
-                clss = detection_graph.get_tensor_by_name('detection_classes:0')
-                num_detections = detection_graph.get_tensor_by_name('num_detections:0')
+                    # Actual detection
+                    (box, score, clss, num_detections) = run_detector(imageBatch)
+
+                    # This implicitly banks on TF giving us back a fixed number of boxes, let's 
+                    # assert on this to make sure this doesn't silently break in the future.
+                    if nDetections == -1:
+                        nDetections = box.shape[1]
+                        boxes = np.empty((nImages,nDetections,4), dtype=box.dtype)
+                        scores = np.empty((nImages,nDetections), dtype=score.dtype)
+                    
+                        # Returned as floats, but really representing ints
+                        classes = np.empty((nImages,nDetections), dtype=int)
+                    
+                    assert box.shape[1] == nDetections, 'Detection count mismatch'
                 
-                # Actual detection
-                (box, score, clss, num_detections) = sess.run(
-                        [box, score, clss, num_detections],
-                        feed_dict={image_tensor: imageNP_expanded})
-
-                boxes.append(box)
-                scores.append(score)
-                classes.append(clss)
+                    # Put results back in the same order as the input images
+                    imageIndices = [iImage for iImage,_ in batch]
+                    boxes[imageIndices] = box
+                    scores[imageIndices] = score
+                    classes[imageIndices] = clss
+                    if bReturnImages:
+                        for iImage,imageNP in batch:
+                            images[iImage] = imageNP
+                    if batchCallback is not None:
+                        batchCallback(imageIndices,[imageNP for _,imageNP in batch],
+                                      boxes[imageIndices],scores[imageIndices],classes[imageIndices])
             
-                if iImage == 0:
-                    firstImageCompleteTime = time.time()
+                    if firstImageCompleteTime is None:
+                        firstImageCompleteTime = time.perf_counter()
+                        nImagesInFirstBatch = len(batch)
+                    
+                    progressBar.update(len(batch))
                     
-            # ...for each image                
+                # ...for each batch
+            
+                progressBar.close()
     
-        # ...with tf.Session
+            # ...with tf.Session
 
-    # ...with detection_graph.as_default()
+        # ...with detection_graph.as_default()
     
-    elapsed = time.time() - startTime
-    if nImages == 1:
-        print("Finished running detector in {}".format(humanfriendly.format_timespan(elapsed)))
-    else:
-        firstImageElapsed = firstImageCompleteTime - startTime
-        remainingImagesElapsed = elapsed - firstImageElapsed
-        remainingImagesTimePerImage = remainingImagesElapsed/(nImages-1)
-        
-        print("Finished running detector on {} images in {} ({} for the first image, {} for each subsequent image)".format(len(images),
-              humanfriendly.format_timespan(elapsed),
-              humanfriendly.format_timespan(firstImageElapsed),
-              humanfriendly.format_timespan(remainingImagesTimePerImage)))
-    
-    nBoxes = len(boxes)
-    
-    # Currently "boxes" is a list of length nImages, where each element is shaped as
-    #
-    # 1,nDetections,4
-    #
-    # This implicitly banks on TF giving us back a fixed number of boxes, let's assert on this
-    # to make sure this doesn't silently break in the future.
-    nDetections = -1
-    # iBox = 0; box = boxes[iBox]
-    for iBox,box in enumerate(boxes):
-        nDetectionsThisBox = box.shape[1]
-        assert (nDetections == -1 or nDetectionsThisBox == nDetections), 'Detection count mismatch'
-        nDetections = nDetectionsThisBox
-        assert(box.shape[0] == 1)
-    
-    # "scores" is a length-nImages list of elements with size 1,nDetections
-    assert(len(scores) == nImages)
-    for(iScore,score) in enumerate(scores):
-        assert score.shape[0] == 1
-        assert score.shape[1] == nDetections
-        
-    # "classes" is a length-nImages list of elements with size 1,nDetections
-    #
-    # Still as floats, but really representing ints
-    assert(len(classes) == nBoxes)
-    for(iClass,c) in enumerate(classes):
-        assert c.shape[0] == 1
-        assert c.shape[1] == nDetections
-            
-    # Squeeze out the empty axis
-    boxes = np.squeeze(np.array(boxes),axis=1)
-    scores = np.squeeze(np.array(scores),axis=1)
-    classes = np.squeeze(np.array(classes),axis=1).astype(int)
-    
-    # boxes is nImages x nDetections x 4
-    assert(len(boxes.shape) == 3)
-    assert(boxes.shape[0] == nImages)
-    assert(boxes.shape[1] == nDetections)
-    assert(boxes.shape[2] == 4)
-    
-    # scores and classes are both nImages x nDetections
-    assert(len(scores.shape) == 2)
-    assert(scores.shape[0] == nImages)
-    assert(scores.shape[1] == nDetections)
-    
-    assert(len(classes.shape) == 2)
-    assert(classes.shape[0] == nImages)
-    assert(classes.shape[1] == nDetections)
+    # ...with ThreadPool
     
+    elapsed = time.perf_counter() - startTime
+    if bVerbose:
+        if nImagesInFirstBatch == nImages:
+            print("Finished loading {} image(s) and running detector in {}".format(nImages,
+                  humanfriendly.format_timespan(elapsed)))
+        else:
+            firstImageElapsed = firstImageCompleteTime - startTime
+            remainingImagesElapsed = elapsed - firstImageElapsed
+            remainingImagesTimePerImage = remainingImagesElapsed/(nImages-nImagesInFirstBatch)
+            
+            print("Finished loading images and running detector on {} images in {} ({} for the first {} image(s), {} for each subsequent image)".format(nImages,
+                  humanfriendly.format_timespan(elapsed),
+                  humanfriendly.format_timespan(firstImageElapsed),
+                  nImagesInFirstBatch,
+                  humanfriendly.format_timespan(remainingImagesTimePerImage)))
+    
+    if not bReturnImages:
+        images = None
+        
     return boxes,scores,classes,images
 
 
@@ -261,7 +466,8 @@ def render_bounding_box(box, score, classLabel, inputFileName, outputFileName=No
 
 
 def render_bounding_boxes(boxes, scores, classes, inputFileNames, outputFileNames=[],
-                          confidenceThreshold=DEFAULT_CONFIDENCE_THRESHOLD, linewidth=DEFAULT_LINE_WIDTH):
+                          confidenceThreshold=DEFAULT_CONFIDENCE_THRESHOLD, linewidth=DEFAULT_LINE_WIDTH,
+                          images=None):
     """
     Render bounding boxes on the image files specified in [inputFileNames].  
     
@@ -271,11 +477,18 @@ def render_bounding_boxes(boxes, scores, classes, inputFileNames, outputFileName
     
     "classes" is currently unused, it's a placeholder for adding text annotations
     later.
+    
+    If [images] is supplied, it should be the RGB numpy arrays corresponding to 
+    [inputFileNames] (e.g. as returned by generate_detections), which are rendered
+    instead of re-reading the input files.
+    
+    Draws with OpenCV if it's available, otherwise with matplotlib.
     """
 
     nImages = len(inputFileNames)
-    iImage = 0
-
+    
+    fullOutputFileNames = []
+    
     for iImage in range(0,nImages):
 
         inputFileName = inputFileNames[iImage]
@@ -288,39 +501,158 @@ def render_bounding_boxes(boxes, scores, classes, inputFileNames, outputFileName
         if len(outputFileName) == 0:
             name, ext = os.path.splitext(inputFileName)
             outputFileName = "{}{}{}".format(name,DETECTION_FILENAME_INSERT,ext)
+            
+        fullOutputFileNames.append(outputFileName)
+
+    if bOpenCVAvailable:
+        render_bounding_boxes_opencv(boxes, scores, classes, inputFileNames, fullOutputFileNames,
+                                     confidenceThreshold, linewidth, images)
+    else:
+        render_bounding_boxes_matplotlib(boxes, scores, classes, inputFileNames, fullOutputFileNames,
+                                         confidenceThreshold, linewidth, images)
+
+# ...def render_bounding_boxes
+
+
+def render_bounding_boxes_opencv(boxes, scores, classes, inputFileNames, outputFileNames,
+                                 confidenceThreshold, linewidth, images=None):
+    """
+    Render bounding boxes with OpenCV, drawing directly on the image pixels; see 
+    render_bounding_boxes for parameter formats.  [outputFileNames] must be complete.
+    """
+    
+    # Line widths and font sizes are specified in points, as they are for matplotlib
+    dpi = 100
+    thickness = max(1,int(round(linewidth * dpi / 72.0)))
+    fontScale = 0.75
+    
+    for iImage,inputFileName in enumerate(inputFileNames):
+        
+        outputFileName = outputFileNames[iImage]
+        
+        # Drawing on a converted copy, so we don't modify the caller's images
+        if images is not None:
+            image = cv2.cvtColor(images[iImage], cv2.COLOR_RGB2BGR)
+        else:
+            # Like the decoders we run the detector on, don't apply EXIF orientation, so
+            # boxes line up with the pixels they were detected on
+            image = cv2.imread(inputFileName, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        
+        # OpenCV can't read every format we support (e.g. .gif)
+        if image is None:
+            image = np.array(PIL.Image.open(inputFileName).convert('RGB'))
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            
+        s = image.shape; imageHeight = s[0]; imageWidth = s[1]
+        
+        # Only look at boxes above the threshold, and convert them all to pixel 
+        # coordinates at once
+        #
+        # top, left, bottom, right 
+        #
+        # x,y origin is the upper-left
+        iBoxesToRender = np.flatnonzero(np.asarray(scores[iImage]) >= confidenceThreshold)
+        pixelBoxes = np.rint(np.asarray(boxes[iImage])[iBoxesToRender] * 
+                             [imageHeight,imageWidth,imageHeight,imageWidth]).astype(int).tolist()
+            
+        for iBox,(iTop,iLeft,iBottom,iRight) in zip(iBoxesToRender,pixelBoxes):
+
+            score = scores[iImage][iBox]
+            iClass = int(classes[iImage][iBox])
+            
+            boxColor = BOX_COLORS_BGR[iClass % len(BOX_COLORS_BGR)]
+            cv2.rectangle(image, (iLeft,iTop), (iRight,iBottom), boxColor, thickness)
+            
+            if SHOW_CONFIDENCE_VALUES:
+                pLabel = 'Class {} ({:.2f})'.format(iClass,score)
+                (textWidth,textHeight),baseline = cv2.getTextSize(pLabel, cv2.FONT_HERSHEY_SIMPLEX,
+                                                                  fontScale, 1)
+                cv2.rectangle(image, (iLeft+5,iTop+5), 
+                              (iLeft+5+textWidth,iTop+5+textHeight+baseline), (0,0,0), -1)
+                cv2.putText(image, pLabel, (iLeft+5,iTop+5+textHeight), cv2.FONT_HERSHEY_SIMPLEX,
+                            fontScale, boxColor, 1, cv2.LINE_AA)
+            
+        # ...for each box
+        
+        writeParams = []
+        if os.path.splitext(outputFileName)[1].lower() in ('.jpg','.jpeg'):
+            writeParams = [cv2.IMWRITE_JPEG_QUALITY, 90]
+            
+        # OpenCV can't write every format we support either
+        try:
+            bWritten = cv2.imwrite(outputFileName, image, writeParams)
+        except cv2.error:
+            bWritten = False
+        if not bWritten:
+            PIL.Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(outputFileName)
+        
+    # ...for each image
+
+# ...def render_bounding_boxes_opencv
 
-        image = mpimg.imread(inputFileName)
+
+def render_bounding_boxes_matplotlib(boxes, scores, classes, inputFileNames, outputFileNames,
+                                     confidenceThreshold, linewidth, images=None):
+    """
+    Render bounding boxes with matplotlib; see render_bounding_boxes for parameter 
+    formats.  [outputFileNames] must be complete.
+    """
+    
+    # Creating a figure is expensive, so we use the same one for every image, just 
+    # resizing it to fit each image
+    dpi = 100
+    fig = plt.figure(dpi=dpi)
+    ax = fig.add_axes([0,0,1,1])
+    
+    # Hide the axes, and make the image fill the whole figure
+    ax.set_axis_off()
+    ax.xaxis.set_major_locator(ticker.NullLocator())
+    ax.yaxis.set_major_locator(ticker.NullLocator())
+    ax.set_aspect(1)
+    
+    axesImage = None
+    
+    for iImage,inputFileName in enumerate(inputFileNames):
+        
+        outputFileName = outputFileNames[iImage]
+        
+        if images is not None:
+            image = images[iImage]
+        else:
+            image = mpimg.imread(inputFileName)
         iBox = 0; box = boxes[iImage][iBox]
-        dpi = 100
         s = image.shape; imageHeight = s[0]; imageWidth = s[1]
         figsize = imageWidth / float(dpi), imageHeight / float(dpi)
 
-        plt.figure(figsize=figsize)
-        ax = plt.axes([0,0,1,1])
+        # Remove the previous image's boxes
+        for artist in list(ax.patches) + list(ax.texts):
+            artist.remove()
+        
+        fig.set_size_inches(figsize)
         
         # Display the image
-        ax.imshow(image)
-        ax.set_axis_off()
+        if axesImage is None:
+            axesImage = ax.imshow(image)
+        else:
+            axesImage.set_data(image)
+            axesImage.set_extent((-0.5,imageWidth-0.5,imageHeight-0.5,-0.5))
     
         # plt.show()
-        for iBox,box in enumerate(boxes[iImage]):
+        
+        # Only look at boxes above the threshold, and convert them all to pixel 
+        # coordinates at once
+        #
+        # top, left, bottom, right 
+        #
+        # x,y origin is the upper-left
+        iBoxesToRender = np.flatnonzero(np.asarray(scores[iImage]) >= confidenceThreshold)
+        boxesToRender = np.asarray(boxes[iImage])[iBoxesToRender]
+        xy = boxesToRender[:,[1,0]] * [imageWidth,imageHeight]
+        wh = (boxesToRender[:,[3,2]] - boxesToRender[:,[1,0]]) * [imageWidth,imageHeight]
+        
+        for iBox,(x,y),(w,h) in zip(iBoxesToRender,xy,wh):
 
             score = scores[iImage][iBox]
-            if score < confidenceThreshold:
-                continue
-
-            # top, left, bottom, right 
-            #
-            # x,y origin is the upper-left
-            topRel = box[0]
-            leftRel = box[1]
-            bottomRel = box[2]
-            rightRel = box[3]
-            
-            x = leftRel * imageWidth
-            y = topRel * imageHeight
-            w = (rightRel-leftRel) * imageWidth
-            h = (bottomRel-topRel) * imageHeight
             
             # Location is the bottom-left of the rect
             #
@@ -343,28 +675,24 @@ def render_bounding_boxes(boxes, scores, classes, inputFileNames, outputFileName
             
         # ...for each box
 
-        # This is magic goop that removes whitespace around image plots (sort of)        
-        plt.subplots_adjust(top = 1, bottom = 0, right = 1, left = 0, hspace = 0, 
-                            wspace = 0)
-        plt.margins(0,0)
-        ax.xaxis.set_major_locator(ticker.NullLocator())
-        ax.yaxis.set_major_locator(ticker.NullLocator())
-        ax.axis('tight')
-        ax.set(xlim=[0,imageWidth],ylim=[imageHeight,0],aspect=1)
-        plt.axis('off')                
+        ax.set_xlim(0,imageWidth)
+        ax.set_ylim(imageHeight,0)
 
         # plt.savefig(outputFileName, bbox_inches='tight', pad_inches=0.0, dpi=dpi, transparent=True)
-        plt.savefig(outputFileName, dpi=dpi, transparent=True, optimize=True, quality=90)
-        plt.close()
+        fig.savefig(outputFileName, dpi=dpi, transparent=True, optimize=True, quality=90)
         # os.startfile(outputFileName)
 
     # ...for each image
+    
+    plt.close(fig)
 
-# ...def render_bounding_boxes
+# ...def render_bounding_boxes_matplotlib
 
 
 def load_and_run_detector(modelFile, imageFileNames, outputDir=None,
-                          confidenceThreshold=DEFAULT_CONFIDENCE_THRESHOLD, detection_graph=None):
+                          confidenceThreshold=DEFAULT_CONFIDENCE_THRESHOLD, detection_graph=None,
+                          batchSize=DEFAULT_BATCH_SIZE, bEnableXla=False, bUseTensorRT=False,
+                          bUseFp16=False, bUseInt8=False, bForceCpu=False):
     
     if len(imageFileNames) == 0:        
         print('Warning: no files available')
@@ -372,18 +700,19 @@ def load_and_run_detector(modelFile, imageFileNames, outputDir=None,
         
     # Load and run detector on target images
     print('Loading model...')
-    startTime = time.time()
+    startTime = time.perf_counter()
     if detection_graph is None:
-        detection_graph = load_model(modelFile)
-    elapsed = time.time() - startTime
+        calibrationImages = None
+        if bUseInt8:
+            calibrationImages = imageFileNames[0:NUM_INT8_CALIBRATION_IMAGES]
+        detection_graph = load_model(modelFile,bUseTensorRT,maxBatchSize=batchSize,bUseFp16=bUseFp16,
+                                     calibrationImages=calibrationImages)
+    elapsed = time.perf_counter() - startTime
     print("Loaded model in {}".format(humanfriendly.format_timespan(elapsed)))
     
-    boxes,scores,classes,images = generate_detections(detection_graph,imageFileNames)
-    
-    assert len(boxes) == len(imageFileNames)
-    
-    print('Rendering output...')
-    startTime = time.time()
+    # TensorRT handles FP16 itself; otherwise let TensorFlow choose which ops to run in FP16
+    sessionConfig = get_session_config(bEnableXla, bUseMixedPrecision=(bUseFp16 and not bUseTensorRT),
+                                       bForceCpu=bForceCpu)
     
     outputFullPaths = []
     outputFileNames = {}
@@ -392,7 +721,7 @@ def load_and_run_detector(modelFile, imageFileNames, outputDir=None,
             
         os.makedirs(outputDir,exist_ok=True)
         
-        for iFn,fullInputPath in enumerate(tqdm(imageFileNames)):
+        for iFn,fullInputPath in enumerate(imageFileNames):
             
             fn = os.path.basename(fullInputPath).lower()            
             name, ext = os.path.splitext(fn)
@@ -414,12 +743,30 @@ def load_and_run_detector(modelFile, imageFileNames, outputDir=None,
     
     plt.ioff()
     
-    render_bounding_boxes(boxes=boxes, scores=scores, classes=classes, 
-                          inputFileNames=imageFileNames, outputFileNames=outputFullPaths,
-                          confidenceThreshold=confidenceThreshold)
+    # Render each batch as soon as the detector has run on it, so we don't have to either 
+    # hang on to every image or load every image twice
+    renderTime = 0
+    
+    def render_batch(imageIndices,imageBatch,boxes,scores,classes):
+        nonlocal renderTime
+        startTime = time.perf_counter()
+        batchOutputFileNames = []
+        if outputDir is not None:
+            batchOutputFileNames = [outputFullPaths[iImage] for iImage in imageIndices]
+        render_bounding_boxes(boxes=boxes, scores=scores, classes=classes, 
+                              inputFileNames=[imageFileNames[iImage] for iImage in imageIndices],
+                              outputFileNames=batchOutputFileNames,
+                              confidenceThreshold=confidenceThreshold, images=imageBatch)
+        renderTime += time.perf_counter() - startTime
+        
+    boxes,scores,classes,_ = generate_detections(detection_graph,imageFileNames,batchSize,
+                                                 sessionConfig=sessionConfig,
+                                                 batchCallback=render_batch)
+    
+    assert len(boxes) == len(imageFileNames)
     
-    elapsed = time.time() - startTime
-    print("Rendered output in {}".format(humanfriendly.format_timespan(elapsed)))
+    print("Rendered output in {} (included in the time above)".format(
+        humanfriendly.format_timespan(renderTime)))
     
     return detection_graph
 
@@ -447,7 +794,7 @@ if False:
 
 #%% File helper functions
 
-imageExtensions = ['.jpg','.jpeg','.gif','.png']
+imageExtensions = frozenset(['.jpg','.jpeg','.gif','.png'])
     
 def isImageFile(s):
     """
@@ -462,26 +809,30 @@ def findImageStrings(strings):
     Given a list of strings that are potentially image file names, look for strings
     that actually look like image file names (based on extension).
     """
-    imageStrings = []
-    bIsImage = [False] * len(strings)
-    for iString,f in enumerate(strings):
-        bIsImage[iString] = isImageFile(f) 
-        if bIsImage[iString]:
-            imageStrings.append(f)
-        
-    return imageStrings
+    return [s for s in strings if isImageFile(s)]
 
     
-def findImages(dirName,bRecursive=False):
+def findImages(dirName,bRecursive=False,excludeSubstring=DETECTION_FILENAME_INSERT):
     """
     Find all files in a directory that look like image file names
+    
+    Like glob, skips files and directories whose names start with '.'.  Also skips files
+    whose names contain [excludeSubstring], by default our own rendered results.
     """
+    imageStrings = []
+    
+    def isCandidate(fn):
+        return (not fn.startswith('.')) and isImageFile(fn) and \
+            (not excludeSubstring or excludeSubstring not in fn)
+    
     if bRecursive:
-        strings = glob.glob(os.path.join(dirName,'**','*.*'), recursive=True)
+        for root,dirs,files in os.walk(dirName):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            imageStrings.extend(os.path.join(root,fn) for fn in files if isCandidate(fn))
     else:
-        strings = glob.glob(os.path.join(dirName,'*.*'))
-        
-    imageStrings = findImageStrings(strings)
+        with os.scandir(dirName) as it:
+            imageStrings = [entry.path for entry in it 
+                            if isCandidate(entry.name) and entry.is_file()]
     
     return imageStrings
 
@@ -509,6 +860,16 @@ def main():
                         help='Force CPU detection, even if a GPU is available')
     parser.add_argument('--outputDir', type=str, default=None, 
                        help='Directory for output images (defaults to same as input)')
+    parser.add_argument('--batchSize', type=int, default=DEFAULT_BATCH_SIZE, 
+                       help='Number of same-sized images to run through the detector at once')
+    parser.add_argument('--enableXla', action='store_true', 
+                        help='Compile the detector with XLA; usually faster, but recompiles for each new image size')
+    parser.add_argument('--useTensorRT', action='store_true', 
+                        help='Convert the detector with TensorRT (requires a TensorRT-enabled TensorFlow build)')
+    parser.add_argument('--useFp16', action='store_true', 
+                        help='Run the detector in half precision where possible (GPU only)')
+    parser.add_argument('--useInt8', action='store_true', 
+                        help='Run TensorRT engines in INT8, calibrated on the first few images (requires --useTensorRT)')
     
     if len(sys.argv[1:])==0:
         parser.print_help()
@@ -521,6 +882,9 @@ def main():
     elif len(args.imageFile) == 0 and len(args.imageDir) == 0:
         raise Exception('Must specify either an image file or an image directory')
         
+    if args.useInt8 and not args.useTensorRT:
+        raise Exception('INT8 inference requires --useTensorRT')
+        
     if len(args.imageFile) > 0:
         imageFileNames = [args.imageFile]
     else:
@@ -529,14 +893,20 @@ def main():
     if args.forceCpu:
         os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
         os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+        
+        # Thread settings for MKL-enabled TensorFlow builds (e.g. intel-tensorflow), 
+        # which are much faster on Intel CPUs; these are ignored by other builds
+        os.environ['OMP_NUM_THREADS'] = str(os.cpu_count())
+        os.environ['KMP_BLOCKTIME'] = '1'
+        os.environ['KMP_AFFINITY'] = 'granularity=fine,compact,1,0'
 
-    # Hack to avoid running on already-detected images
-    imageFileNames = [x for x in imageFileNames if DETECTION_FILENAME_INSERT not in x]
-                
     print('Running detector on {} images'.format(len(imageFileNames)))    
     
     load_and_run_detector(modelFile=args.detectorFile, imageFileNames=imageFileNames, 
-                          confidenceThreshold=args.threshold, outputDir=args.outputDir)
+                          confidenceThreshold=args.threshold, outputDir=args.outputDir,
+                          batchSize=args.batchSize, bEnableXla=args.enableXla,
+                          bUseTensorRT=args.useTensorRT, bUseFp16=args.useFp16,
+                          bUseInt8=args.useInt8, bForceCpu=args.forceCpu)
     
 
 if __name__ == '__main__':
@@ -17,7 +17,7 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 #%% Functions
 
-def open_image(input):
+def open_image(input, draft_size=None):
     """
     Opens an image in binary format using PIL.Image and convert to RGB mode. This operation is lazy; image will
     not be actually loaded until the first operation that needs to load it (for example, resizing), so file opening
@@ -26,12 +26,17 @@ def open_image(input):
     Args:
         input: an image in binary format read from the POST request's body or
             path to an image file (anything that PIL can open)
+        draft_size: optional (width, height); for JPEGs, asks the decoder to downscale by a power
+            of two during decoding, to the smallest size that's still at least this big.  Has no
+            effect on other formats.
 
     Returns:
         an PIL image object in RGB mode
     """
 
     image = Image.open(input)
+    if draft_size is not None:
+        image.draft('RGB', draft_size)
     if image.mode not in ('RGBA', 'RGB', 'L'):
         raise AttributeError('Input image {} uses unsupported mode {}'.format(input,image.mode))
     if image.mode == 'RGBA' or image.mode == 'L':
@@ -432,7 +437,9 @@ def plot_confusion_matrix(matrix, classes,
     """
 
     assert matrix.shape[0] == matrix.shape[1]
-    fig = plt.figure(figsize=[3 + 0.5 * len(classes)] * 2)
+    # Grow the figure with the number of classes, but not without bound; huge figures
+    # use lots of memory and can exceed the renderer's maximum image size
+    fig = plt.figure(figsize=[min(3 + 0.5 * len(classes), 32)] * 2)
 
     if normalize:
         matrix = matrix.astype(np.double) / (matrix.sum(axis=1, keepdims=True) + 1e-7)